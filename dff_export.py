@@ -0,0 +1,509 @@
+import argparse
+import json
+import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from dff_parser import DffModel, transform_points
+from dff_scan import iter_dff_names
+from img_archive import get_shared_archive
+
+
+GLB_MAGIC = b'glTF'
+GLB_VERSION = 2
+GLB_HEADER = struct.Struct('<4sII')
+GLB_CHUNK_HEADER = struct.Struct('<I4s')
+GLB_CHUNK_JSON = b'JSON'
+GLB_CHUNK_BIN = b'BIN\x00'
+
+GLTF_UNSIGNED_BYTE = 5121
+GLTF_UNSIGNED_SHORT = 5123
+GLTF_UNSIGNED_INT = 5125
+GLTF_FLOAT = 5126
+GLTF_ARRAY_BUFFER = 34962
+GLTF_ELEMENT_ARRAY_BUFFER = 34963
+
+# в RenderWare ось Z смотрит вверх, в glTF - ось Y: поворот корня на -90° вокруг X
+GLTF_Z_UP_ROTATION = [-0.7071068, 0.0, 0.0, 0.7071068]
+
+# сколько строк OBJ форматируется за один раз, ограничивает память
+OBJ_ROWS_PER_WRITE = 65536
+
+# сколько моделей на воркер может ждать в очереди при пакетном экспорте
+MAX_PENDING_MODELS = 2
+
+EXPORT_FORMATS = ('glb', 'obj')
+
+
+def material_name(geometry_index, material_index) -> str:
+    return f'material_{geometry_index}_{material_index}'
+
+
+def get_primitives(model: DffModel, index) -> list[tuple[int, np.ndarray]]:
+    # (номер материала, треугольники (n, 3) uint32) геометрии: из Struct, а у native геометрий из BinMeshPLG
+    pool = model.geometry_pool
+    num_vertices = pool.vertex_offsets[index + 1] - pool.vertex_offsets[index]
+    triangles = pool.triangles[pool.triangle_offsets[index]:pool.triangle_offsets[index + 1]]
+    if len(triangles):
+        triangles = triangles[np.argsort(triangles['material_id'], kind='stable')]
+        materials, starts = np.unique(triangles['material_id'], return_index=True)
+        faces = np.stack([triangles['vertex1'], triangles['vertex2'], triangles['vertex_3']], axis=1).astype(np.uint32)
+        primitives = list(zip(materials.tolist(), np.split(faces, starts[1:])))
+    elif model.bin_meshes[index] is not None:
+        bin_mesh = model.bin_meshes[index]
+        primitives = [
+            (mesh['material_index'], bin_mesh.get_triangles(i).astype(np.uint32))
+            for i, mesh in enumerate(bin_mesh.list_meshes)
+        ]
+    else:
+        return []
+
+    # треугольники с индексами за пределами вершин отбрасываются
+    primitives = [(material, faces[(faces < num_vertices).all(axis=1)]) for material, faces in primitives]
+    return [(material, faces) for material, faces in primitives if len(faces)]
+
+
+def get_nodes(model: DffModel) -> list[tuple[str, int, np.ndarray | None]]:
+    # (имя, номер геометрии, мировая матрица или None) для каждого атомика,
+    # без атомиков - по узлу на геометрию
+    if not model.atomics:
+        return [(f'geometry_{i}', i, None) for i in range(len(model.geometry_chunks))]
+
+    nodes = []
+    world_matrices = model.world_matrices
+    for i, atomic in enumerate(model.atomics):
+        if atomic.geometry_index >= len(model.geometry_chunks):
+            continue
+        matrix = None
+        name = f'atomic_{i}'
+        if atomic.frame_index < len(world_matrices):
+            matrix = world_matrices[atomic.frame_index]
+            frame = model.frames[atomic.frame_index] if atomic.frame_index < len(model.frames) else None
+            if frame is not None:
+                name = frame.node_name
+        nodes.append((name, atomic.geometry_index, matrix))
+    return nodes
+
+
+# - glTF ----------------------------------------------------------------
+
+class GltfBuilder:
+    """
+    Builds the glTF JSON for a DffModel and the list of arrays that make up
+    its binary buffer. Pooled vertex arrays of all geometries go into the
+    buffer as they are, one bufferView per attribute, and every geometry
+    is an accessor at its vertex offset, so no per-vertex data is touched.
+    Only the triangle indices are regrouped by material.
+    """
+
+    def __init__(self, model: DffModel, name='', texture_dir='textures', texture_extension='png'):
+        self.model = model
+        self.name = name
+        # None - без изображений, только цвет материала
+        self.texture_dir = texture_dir
+        self.texture_extension = texture_extension
+        self.gltf = {
+            'asset': {'version': '2.0', 'generator': 'dff_export'},
+            'scene': 0,
+            'scenes': [{'nodes': [0]}],
+            'nodes': [],
+            'meshes': [],
+            'materials': [],
+            'accessors': [],
+            'bufferViews': [],
+            'buffers': [{'byteLength': 0}],
+        }
+        # массивы буфера в порядке записи, каждый выровнен на 4 байта
+        self.blobs: list[np.ndarray] = []
+        self.byte_length = 0
+        self._textures: dict[str, int] = {}
+
+    def add_buffer_view(self, array: np.ndarray, target=None) -> int:
+        array = np.ascontiguousarray(array)
+        buffer_view = {'buffer': 0, 'byteOffset': self.byte_length, 'byteLength': array.nbytes}
+        if target is not None:
+            buffer_view['target'] = target
+        if target == GLTF_ARRAY_BUFFER:
+            # на один bufferView ссылаются accessor'ы всех геометрий
+            buffer_view['byteStride'] = array.itemsize
+        self.gltf['bufferViews'].append(buffer_view)
+        self.blobs.append(array)
+        self.byte_length += (array.nbytes + 3) // 4 * 4
+        return len(self.gltf['bufferViews']) - 1
+
+    def add_accessor(self, buffer_view, byte_offset, component_type, count, accessor_type, **kwargs) -> int:
+        accessor = {
+            'bufferView': buffer_view,
+            'byteOffset': int(byte_offset),
+            'componentType': component_type,
+            'count': int(count),
+            'type': accessor_type,
+            **kwargs
+        }
+        self.gltf['accessors'].append(accessor)
+        return len(self.gltf['accessors']) - 1
+
+    def add_texture(self, texture_name) -> int:
+        index = self._textures.get(texture_name.lower())
+        if index is None:
+            gltf = self.gltf
+            gltf.setdefault('images', []).append({
+                'uri': f'{self.texture_dir}/{texture_name}.{self.texture_extension}',
+                'name': texture_name
+            })
+            gltf.setdefault('textures', []).append({'source': len(gltf['images']) - 1})
+            index = self._textures[texture_name.lower()] = len(gltf['textures']) - 1
+        return index
+
+    def add_materials(self, geometry_index) -> list[int]:
+        # индексы материалов glTF для материалов геометрии
+        indices = []
+        texture_names = self.model.texture_names[geometry_index]
+        for i, material in enumerate(self.model.materials[geometry_index]):
+            color = material.color
+            pbr = {
+                'baseColorFactor': [color.r / 255, color.g / 255, color.b / 255, color.a / 255],
+                'metallicFactor': 0.0,
+                'roughnessFactor': 1.0,
+            }
+            texture_name = texture_names[i][0] if i < len(texture_names) and texture_names[i] else None
+            if texture_name and self.texture_dir is not None:
+                pbr['baseColorTexture'] = {'index': self.add_texture(texture_name)}
+
+            gltf_material = {'name': material_name(geometry_index, i), 'pbrMetallicRoughness': pbr}
+            if color.a < 255:
+                gltf_material['alphaMode'] = 'BLEND'
+            self.gltf['materials'].append(gltf_material)
+            indices.append(len(self.gltf['materials']) - 1)
+        return indices
+
+    def build(self):
+        model = self.model
+        pool = model.geometry_pool
+        offsets = pool.vertex_offsets
+        num_tex_sets = (pool.flags >> 16) & 0xFF
+
+        # пулы вершинных атрибутов целиком, по одному bufferView на атрибут
+        positions = self.add_buffer_view(pool.vertices, GLTF_ARRAY_BUFFER)
+        normals = self.add_buffer_view(pool.normals, GLTF_ARRAY_BUFFER) if pool.has_normals.any() else None
+        tex_coords = self.add_buffer_view(pool.tex_coords, GLTF_ARRAY_BUFFER) if num_tex_sets.any() else None
+        colors = self.add_buffer_view(pool.prelitcolor, GLTF_ARRAY_BUFFER) if pool.has_prelit.any() else None
+
+        # индексы всех примитивов в одном массиве
+        index_arrays = []
+        index_count = 0
+        geometry_primitives = []
+        for i in range(len(pool)):
+            primitives = get_primitives(model, i) if offsets[i + 1] > offsets[i] else []
+            geometry_primitives.append(primitives)
+            for material, faces in primitives:
+                index_arrays.append(faces.reshape(-1))
+                index_count += faces.size
+
+        index_type, index_dtype = GLTF_UNSIGNED_INT, np.uint32
+        if offsets[-1] <= 0xFFFF:
+            index_type, index_dtype = GLTF_UNSIGNED_SHORT, np.uint16
+        indices = np.empty(index_count, index_dtype)
+        if index_arrays:
+            np.concatenate(index_arrays, out=indices, casting='unsafe')
+        indices_view = self.add_buffer_view(indices, GLTF_ELEMENT_ARRAY_BUFFER) if index_count else None
+
+        mesh_indices = []
+        index_offset = 0
+        for i, primitives in enumerate(geometry_primitives):
+            if not primitives:
+                mesh_indices.append(None)
+                continue
+
+            start, count = offsets[i], offsets[i + 1] - offsets[i]
+            vertices = pool.vertices[start:start + count]
+            xyz = np.stack([vertices['x'], vertices['y'], vertices['z']], axis=1)
+            attributes = {'POSITION': self.add_accessor(
+                positions, start * pool.vertices.itemsize, GLTF_FLOAT, count, 'VEC3',
+                min=xyz.min(axis=0).tolist(), max=xyz.max(axis=0).tolist()
+            )}
+            if normals is not None and pool.has_normals[i]:
+                attributes['NORMAL'] = self.add_accessor(
+                    normals, start * pool.normals.itemsize, GLTF_FLOAT, count, 'VEC3'
+                )
+            if tex_coords is not None and num_tex_sets[i]:
+                attributes['TEXCOORD_0'] = self.add_accessor(
+                    tex_coords, start * pool.tex_coords.itemsize, GLTF_FLOAT, count, 'VEC2'
+                )
+            if colors is not None and pool.has_prelit[i]:
+                attributes['COLOR_0'] = self.add_accessor(
+                    colors, start * pool.prelitcolor.itemsize, GLTF_UNSIGNED_BYTE, count, 'VEC4', normalized=True
+                )
+
+            materials = self.add_materials(i)
+            gltf_primitives = []
+            for material, faces in primitives:
+                primitive = {
+                    'attributes': attributes,
+                    'indices': self.add_accessor(
+                        indices_view, index_offset * indices.itemsize, index_type, faces.size, 'SCALAR'
+                    )
+                }
+                if material < len(materials):
+                    primitive['material'] = materials[material]
+                gltf_primitives.append(primitive)
+                index_offset += faces.size
+
+            self.gltf['meshes'].append({'name': f'geometry_{i}', 'primitives': gltf_primitives})
+            mesh_indices.append(len(self.gltf['meshes']) - 1)
+
+        nodes = self.gltf['nodes']
+        nodes.append({'name': self.name, 'rotation': GLTF_Z_UP_ROTATION, 'children': []})
+        for name, geometry_index, matrix in get_nodes(model):
+            node = {'name': name}
+            if mesh_indices[geometry_index] is not None:
+                node['mesh'] = mesh_indices[geometry_index]
+            if matrix is not None:
+                # строки матрицы RenderWare - это столбцы матрицы glTF, порядок данных тот же
+                matrix = matrix.astype(np.float64)
+                matrix[:3, 3] = 0
+                matrix[3, 3] = 1
+                if not np.array_equal(matrix, np.eye(4)):
+                    node['matrix'] = matrix.reshape(-1).tolist()
+            nodes[0]['children'].append(len(nodes))
+            nodes.append(node)
+
+        self.gltf['buffers'][0]['byteLength'] = self.byte_length
+        for key in ('meshes', 'materials', 'accessors', 'bufferViews'):
+            if not self.gltf[key]:
+                del self.gltf[key]
+        if not self.byte_length:
+            del self.gltf['buffers']
+        return self
+
+    def write_glb(self, path):
+        # JSON и массивы пишутся в файл по очереди, общий буфер не собирается
+        data = json.dumps(self.gltf, separators=(',', ':')).encode('utf-8')
+        data += b' ' * (-len(data) % 4)
+        length = GLB_HEADER.size + GLB_CHUNK_HEADER.size + len(data)
+        if self.byte_length:
+            length += GLB_CHUNK_HEADER.size + self.byte_length
+
+        with open(path, 'wb') as f:
+            f.write(GLB_HEADER.pack(GLB_MAGIC, GLB_VERSION, length))
+            f.write(GLB_CHUNK_HEADER.pack(len(data), GLB_CHUNK_JSON))
+            f.write(data)
+            if self.byte_length:
+                f.write(GLB_CHUNK_HEADER.pack(self.byte_length, GLB_CHUNK_BIN))
+                for blob in self.blobs:
+                    f.write(blob.view(np.uint8))
+                    f.write(b'\x00' * (-blob.nbytes % 4))
+
+
+def write_glb(model: DffModel, path, texture_dir='textures', texture_extension='png'):
+    GltfBuilder(model, Path(path).stem, texture_dir, texture_extension).build().write_glb(path)
+
+
+# - OBJ -----------------------------------------------------------------
+
+def _write_rows(f, fmt, rows: np.ndarray):
+    # Как np.savetxt, но строка формата размножается на пачку строк
+    # и форматируется одной операцией, без цикла по строкам
+    for start in range(0, len(rows), OBJ_ROWS_PER_WRITE):
+        batch = rows[start:start + OBJ_ROWS_PER_WRITE]
+        f.write((fmt * len(batch)) % tuple(batch.reshape(-1).tolist()))
+
+
+def write_obj(model: DffModel, path, texture_dir='textures', texture_extension='png'):
+    # Геометрии атомиков в мировых координатах, материалы в .mtl рядом
+    pool = model.geometry_pool
+    num_tex_sets = (pool.flags >> 16) & 0xFF
+    mtl_path = Path(path).with_suffix('.mtl')
+    used_materials = {}
+    counts = {'v': 0, 'vt': 0, 'vn': 0}
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'mtllib {mtl_path.name}\n')
+        for name, i, matrix in get_nodes(model):
+            primitives = get_primitives(model, i)
+            if not primitives:
+                continue
+            geometry = pool.get_geometry(i)
+            vertices = geometry['vertices']
+            xyz = np.stack([vertices['x'], vertices['y'], vertices['z']], axis=1)
+            if matrix is not None:
+                xyz = transform_points(xyz, matrix)
+
+            f.write(f'o {name}\n')
+            _write_rows(f, 'v %.6f %.6f %.6f\n', xyz)
+            # индексы v, vt, vn каждой вершины треугольника, с 1
+            columns = [counts['v'] + 1]
+            counts['v'] += len(xyz)
+
+            if num_tex_sets[i]:
+                tex_coords = geometry['tex_coords']
+                # в OBJ v растет вверх, в RenderWare вниз
+                _write_rows(f, 'vt %.6f %.6f\n', np.stack([tex_coords['u'], 1 - tex_coords['v']], axis=1))
+                columns.append(counts['vt'] + 1)
+                counts['vt'] += len(xyz)
+            if pool.has_normals[i]:
+                normals = geometry['normals']
+                normals = np.stack([normals['x'], normals['y'], normals['z']], axis=1)
+                if matrix is not None:
+                    normals = normals @ matrix[:3, :3]
+                _write_rows(f, 'vn %.6f %.6f %.6f\n', normals)
+                columns.append(counts['vn'] + 1)
+                counts['vn'] += len(xyz)
+
+            if len(columns) == 1:
+                corner = '%d'
+            elif len(columns) == 3:
+                corner = '%d/%d/%d'
+            elif num_tex_sets[i]:
+                corner = '%d/%d'
+            else:
+                corner = '%d//%d'
+            fmt = f'f {corner} {corner} {corner}\n'
+            bases = np.array(columns, np.int64)
+
+            materials = model.materials[i]
+            for material, faces in primitives:
+                if material < len(materials):
+                    mtl_name = material_name(i, material)
+                    used_materials[mtl_name] = (i, material)
+                    f.write(f'usemtl {mtl_name}\n')
+                # (n, 3) -> (n, 3 * число индексов вершины)
+                rows = (faces.astype(np.int64)[:, :, None] + bases).reshape(len(faces), -1)
+                _write_rows(f, fmt, rows)
+
+    with open(mtl_path, 'w', encoding='utf-8') as f:
+        for name, (i, material) in used_materials.items():
+            color = model.materials[i][material].color
+            f.write(f'newmtl {name}\n')
+            f.write(f'Kd {color.r / 255:.6f} {color.g / 255:.6f} {color.b / 255:.6f}\n')
+            f.write(f'd {color.a / 255:.6f}\n')
+            texture_names = model.texture_names[i]
+            if texture_dir is not None and material < len(texture_names) and texture_names[material]:
+                f.write(f'map_Kd {texture_dir}/{texture_names[material][0]}.{texture_extension}\n')
+            f.write('\n')
+
+
+def export_model(source, output_path, texture_dir='textures', texture_extension='png'):
+    # Формат по расширению output_path: .glb или .obj. Файлы, которые
+    # не удалось разобрать, не пишутся, недописанный вывод удаляется
+    is_obj = Path(output_path).suffix.lower() == '.obj'
+    with DffModel.open(source) as model:
+        try:
+            if is_obj:
+                write_obj(model, output_path, texture_dir, texture_extension)
+            else:
+                write_glb(model, output_path, texture_dir, texture_extension)
+        except Exception:
+            paths = [output_path, Path(output_path).with_suffix('.mtl')] if is_obj else [output_path]
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+
+# - Воркер ------------------------------------------------------------
+
+def _export_model(img_path, name, output_path, texture_dir, texture_extension):
+    data = None
+    try:
+        source = name if img_path is None else (data := get_shared_archive(img_path).get_data(name))
+        export_model(source, output_path, texture_dir, texture_extension)
+        error = None
+    except Exception as ex:
+        error = f'{type(ex).__name__}: {ex}'
+    finally:
+        if data is not None:
+            data.release()
+    return name, output_path, error
+
+
+# - Родительский процесс ----------------------------------------------
+
+def get_output_names(img_path, names) -> list[str]:
+    # Пути вывода без расширения: у папок и glob - относительно общей папки моделей,
+    # чтобы models/a.dff и models/sub/a.dff не писались в один файл
+    if img_path is not None or not names:
+        return [os.path.splitext(name)[0] for name in names]
+    paths = [os.path.abspath(name) for name in names]
+    base = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return [os.path.splitext(os.path.relpath(path, base))[0] for path in paths]
+
+
+def export_models(source, output_dir, file_format='glb', workers=None, texture_dir='textures', texture_extension='png'):
+    """
+    Exports every DFF of a directory, glob pattern or IMG archive on a
+    process pool, keeping the subdirectory layout of the source. Each worker opens, writes and closes one model at a time
+    and only names travel between processes; at most MAX_PENDING_MODELS
+    models per worker are queued, so memory does not grow with the archive.
+    Yields (name, output_path, error) in source order, error is None on success.
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unsupported model format {file_format!r}')
+    img_path, names = iter_dff_names(source)
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count()
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            for name, output_name in zip(names, get_output_names(img_path, names)):
+                output_path = os.path.join(output_dir, f'{output_name}.{file_format}')
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                # texture_dir задан относительно output_dir, модели из подпапок ссылаются на него через ..
+                model_texture_dir = texture_dir
+                subdirs = Path(output_name).parent.parts
+                if texture_dir is not None and subdirs and not os.path.isabs(texture_dir):
+                    model_texture_dir = '../' * len(subdirs) + texture_dir
+                pending.append(executor.submit(
+                    _export_model, img_path, name, output_path, model_texture_dir, texture_extension
+                ))
+                while len(pending) >= workers * MAX_PENDING_MODELS:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Экспорт DFF моделей в glTF (.glb) и OBJ')
+    parser.add_argument('source', help='DFF файл, папка, glob или IMG архив')
+    parser.add_argument('-o', '--output', default='./exported_models')
+    parser.add_argument('-f', '--format', choices=EXPORT_FORMATS, default='glb')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='количество процессов')
+    parser.add_argument('--textures', default='textures', help='путь к текстурам относительно папки вывода')
+    parser.add_argument('--texture-format', default='png', help='расширение файлов текстур')
+    parser.add_argument('--no-textures', action='store_true', help='не ссылаться на файлы текстур')
+    args = parser.parse_args()
+
+    texture_dir = None if args.no_textures else args.textures
+    if os.path.isfile(args.source) and Path(args.source).suffix.lower() == '.dff':
+        os.makedirs(args.output, exist_ok=True)
+        output_path = os.path.join(args.output, f'{Path(args.source).stem}.{args.format}')
+        try:
+            export_model(args.source, output_path, texture_dir, args.texture_format)
+        except Exception as ex:
+            print(f'{type(ex).__name__}: {ex}', f'File: {args.source}')
+            raise SystemExit(1)
+        print(f'Сохранено: {output_path}')
+        return
+
+    exported = errors = 0
+    for name, output_path, error in export_models(
+        args.source, args.output, args.format, args.jobs, texture_dir, args.texture_format
+    ):
+        if error is None:
+            exported += 1
+        else:
+            errors += 1
+            print(error, f'File: {name}')
+    print(f'Сохранено моделей: {exported}, ошибок: {errors}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,11 @@
 import struct
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from enum import Enum
+from functools import cached_property
+
+import numpy as np
+
+from rw_stream import CHUNK_HEADER, BufferStream, ChunkWalker, open_stream, read_array
 
 
 def unpack_version(libid):
@@ -40,6 +45,37 @@ class SectionType(Enum):
     TWOD_EFFECT = 0x253f2f8
 
 
+SECTION_TYPES = {section_type.value: section_type for section_type in SectionType}
+
+# секции, в которые заходит ChunkWalker, у остальных тело разбирается целиком
+DFF_CONTAINERS = frozenset({
+    SectionType.CLUMP.value,
+    SectionType.FRAME_LIST.value,
+    SectionType.EXTENSION.value,
+    SectionType.GEOMETRY_LIST.value,
+    SectionType.GEOMETRY.value,
+    SectionType.MATERIAL_LIST.value,
+    SectionType.MATERIAL.value,
+    SectionType.TEXTURE.value,
+    SectionType.ATOMIC.value,
+})
+
+# UV Animation Dictionary, в SA может лежать в файле перед Clump
+SECTION_UV_ANIM_DICTIONARY = 0x2b
+# чанки верхнего уровня DFF, файл с любым другим - не модель
+DFF_TOP_LEVEL_SECTIONS = frozenset({SectionType.CLUMP.value, SECTION_UV_ANIM_DICTIONARY})
+
+# секции, внутри которых могут быть материалы
+TEXTURE_NAME_CONTAINERS = frozenset({
+    SectionType.CLUMP.value,
+    SectionType.GEOMETRY_LIST.value,
+    SectionType.GEOMETRY.value,
+    SectionType.MATERIAL_LIST.value,
+    SectionType.MATERIAL.value,
+    SectionType.TEXTURE.value,
+})
+
+
 @dataclass
 class RWSection:
     section_type: SectionType
@@ -54,11 +90,78 @@ class ClumpSection:
     lights:int 
     cameras: int
 
-# TODO: переделать frame_data
 @dataclass
 class FrameListSection:
+    """
+    frame_data is a RW_FRAME structured array: rotation rows (right, up,
+    at), position, parent index (-1 for roots) and flags per frame.
+    Matrices follow RenderWare's row-vector convention, v_world = v @ M,
+    so a frame's world matrix is its local matrix times its parent's.
+    """
     frame_count: int
-    frame_data: bytes
+    frame_data: np.ndarray
+
+    @property
+    def parents(self) -> np.ndarray:
+        return self.frame_data['parent']
+
+    @cached_property
+    def depths(self) -> np.ndarray:
+        # глубина кадра в иерархии, корни на глубине 0
+        parents = self.parents.astype(np.int64)
+        depths = np.zeros(len(parents), np.int64)
+        current = parents.copy()
+        for _ in range(len(parents)):
+            has_parent = (current >= 0) & (current < len(parents))
+            if not has_parent.any():
+                break
+            depths += has_parent
+            current = np.where(has_parent, parents[np.where(has_parent, current, 0)], -1)
+        return depths
+
+    @cached_property
+    def child_index(self) -> tuple[np.ndarray, np.ndarray]:
+        # (offsets, children): дети кадра i - children[offsets[i]:offsets[i + 1]]
+        parents = self.parents.astype(np.int64)
+        valid = (parents >= 0) & (parents < len(parents))
+        children = np.flatnonzero(valid)
+        children = children[np.argsort(parents[children], kind='stable')]
+        offsets = np.zeros(len(parents) + 1, np.int64)
+        offsets[1:] = np.cumsum(np.bincount(parents[valid], minlength=len(parents)))
+        return offsets, children
+
+    @property
+    def roots(self) -> np.ndarray:
+        return np.flatnonzero(self.depths == 0)
+
+    def get_children(self, index) -> np.ndarray:
+        offsets, children = self.child_index
+        return children[offsets[index]:offsets[index + 1]]
+
+    def local_matrices(self) -> np.ndarray:
+        # (n, 4, 4) float32, строки: right, up, at, position
+        matrices = np.zeros((self.frame_count, 4, 4), np.float32)
+        matrices[:, :3, :3] = self.frame_data['rotation']
+        matrices[:, 3, :3] = self.frame_data['position']
+        matrices[:, 3, 3] = 1
+        return matrices
+
+    def world_matrices(self) -> np.ndarray:
+        # Одно пакетное умножение на уровень иерархии вместо цикла по кадрам
+        world = self.local_matrices()
+        depths = self.depths
+        parents = self.parents
+        for depth in range(1, int(depths.max(initial=0)) + 1):
+            frames = np.flatnonzero(depths == depth)
+            world[frames] = world[frames] @ world[parents[frames]]
+        return world
+
+
+def transform_points(points, matrix) -> np.ndarray:
+    # points: массив RW_V3D или (n, 3), matrix: (4, 4) в соглашении RenderWare
+    if points.dtype.names:
+        points = np.stack([points['x'], points['y'], points['z']], axis=1)
+    return points @ matrix[:3, :3] + matrix[3, :3]
 
 
 @dataclass
@@ -107,6 +210,20 @@ class RwV3d:
     z: float
 ###############################
 
+# Те же структуры в виде dtype NumPy, данные геометрии читаются массивами
+RW_RGBA = np.dtype([('r', 'u1'), ('g', 'u1'), ('b', 'u1'), ('a', 'u1')])
+RW_TEX_COORDS = np.dtype([('u', '<f4'), ('v', '<f4')])
+RP_TRIANGLE = np.dtype([('vertex2', '<u2'), ('vertex1', '<u2'), ('material_id', '<u2'), ('vertex_3', '<u2')])
+RW_V3D = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+
+# 0x38 байт на кадр в Struct секции Frame List
+RW_FRAME = np.dtype([('rotation', '<f4', (3, 3)), ('position', '<f4', 3), ('parent', '<i4'), ('flags', '<u4')])
+
+BIN_MESH_INDEX_32 = np.dtype('<u4')
+BIN_MESH_INDEX_16 = np.dtype('<u2')
+# флаг заголовка BinMeshPLG: индексы - полосы треугольников
+BIN_MESH_TRISTRIP = 0x1
+
 @dataclass
 class GeometrySection:
     format: int
@@ -120,13 +237,26 @@ class GeometrySection:
 
     bounding_sphere: RwSphere | None = None
 
-    prelitcolor: list[RwRGBA] | None = None
-
-    tex_coords: list[RwTexCoords] = field(default_factory=list)
-    triangles: list[RpTriangle] = field(default_factory=list)
-
-    vertices: list[RwV3d] = field(default_factory=list)
-    normals: list[RwV3d] = field(default_factory=list)
+    # Структурированные массивы NumPy (RW_RGBA, RW_TEX_COORDS, RP_TRIANGLE, RW_V3D).
+    # Из файла они читаются через np.frombuffer и ссылаются на его данные
+    prelitcolor: np.ndarray = field(default_factory=lambda: np.empty(0, RW_RGBA))
+
+    tex_coords: np.ndarray = field(default_factory=lambda: np.empty(0, RW_TEX_COORDS))
+    triangles: np.ndarray = field(default_factory=lambda: np.empty(0, RP_TRIANGLE))
+
+    vertices: np.ndarray = field(default_factory=lambda: np.empty(0, RW_V3D))
+    normals: np.ndarray = field(default_factory=lambda: np.empty(0, RW_V3D))
+
+    def as_lists(self) -> 'GeometrySection':
+        # старое представление: списки RwRGBA, RwTexCoords, RpTriangle и RwV3d
+        return replace(
+            self,
+            prelitcolor=[RwRGBA(*item) for item in self.prelitcolor.tolist()],
+            tex_coords=[RwTexCoords(*item) for item in self.tex_coords.tolist()],
+            triangles=[RpTriangle(*item) for item in self.triangles.tolist()],
+            vertices=[RwV3d(*item) for item in self.vertices.tolist()],
+            normals=[RwV3d(*item) for item in self.normals.tolist()]
+        )
 
 
 @dataclass
@@ -170,8 +300,32 @@ class BinMeshPLGSection:
     flags: int
     number_of_meshes: int
     total_number_of_indices: int
+    # {'number_of_indices', 'material_index', 'indices': массив uint32 (uint16 у native)}
     list_meshes: list = field(default_factory=list)
 
+    @property
+    def is_tristrip(self) -> bool:
+        return bool(self.flags & BIN_MESH_TRISTRIP)
+
+    def get_triangles(self, mesh_index) -> np.ndarray:
+        # треугольники меша массивом (n, 3), полосы разворачиваются в список
+        indices = self.list_meshes[mesh_index]['indices']
+        if self.is_tristrip:
+            return tristrip_to_triangles(indices)
+        return indices[:len(indices) // 3 * 3].reshape(-1, 3)
+
+
+def tristrip_to_triangles(indices) -> np.ndarray:
+    # Полоса -> список треугольников: у нечетных порядок первых двух вершин меняется,
+    # вырожденные треугольники (склейки полос) отбрасываются
+    indices = np.asarray(indices)
+    if len(indices) < 3:
+        return np.empty((0, 3), indices.dtype)
+    a, b, c = indices[:-2], indices[1:-1], indices[2:]
+    odd = np.arange(len(a)) & 1 == 1
+    triangles = np.stack([np.where(odd, b, a), np.where(odd, a, b), c], axis=1)
+    return triangles[(a != b) & (b != c) & (a != c)]
+
 @dataclass
 class AtomicStruct:
     frame_index: int
@@ -186,74 +340,45 @@ class ExtraVertColourSection:
 
 
 class DffParser:
+    # file_name: путь, файловый объект или буфер (bytes, memoryview из ImgArchive)
     def __init__(self, file_name):
         self.file = file_name
+        self._owns_stream = False
 
 
-    def get_struct(self) -> RWSection | None:
-        data = self.file_stream.read(12)
-        if len(data) == 0:
-            return None
-        
-        struct_id, size_2, version = struct.unpack('<3I', data)
-        if struct_id == 0:
-            return None
-        if SectionType(struct_id) is SectionType.STRING or SectionType(struct_id) is SectionType.BREAKABLE or SectionType(struct_id) is SectionType.EXTRA_VERT_COLOUR:
-            return RWSection(
-                section_type=SectionType(struct_id),
-                size=size_2,
-                size_2=size_2,
-                version=unpack_version(version)
-            )
-        data = self.file_stream.read(12)
-
-        if len(data) == 0:
-            return None
-        
-        struct_id_2, size, version = struct.unpack('<3I', data)
-        if struct_id_2 == 0:
-            return None
-        
-        if SectionType(struct_id) is SectionType.EXTENSION:
-            struct_id = SectionType(struct_id_2)
-
-        return RWSection(
-            section_type=SectionType(struct_id),
-            size=size,
-            size_2=size_2,
-            version=unpack_version(version)
-        )
-
-    def get_body(self, section_type: SectionType, data: int | None = None) -> ClumpSection:
+    def get_body(self, section_type: SectionType, data: int | None = None, stream=None) -> ClumpSection:
+        if stream is None:
+            stream = self.file_stream
         if section_type is SectionType.CLUMP:
-            atomics, lights, cameras = struct.unpack('<III', self.file_stream.read(12))
+            atomics, lights, cameras = struct.unpack('<III', stream.read(12))
             return ClumpSection(
                 atomics=atomics,
                 lights=lights,
                 cameras=cameras
             )
         if section_type is SectionType.FRAME_LIST:
-            frame_count = struct.unpack('<I', self.file_stream.read(4))[0]
+            frame_count = struct.unpack('<I', stream.read(4))[0]
             # print(frame_count, frame_count * 0x44, 'frame_count')
-            frame_data = self.file_stream.read(frame_count * 0x38)
+            frame_data = read_array(stream, RW_FRAME, frame_count)
             return FrameListSection(
                 frame_count=frame_count,
                 frame_data=frame_data
             )
         if section_type is SectionType.FRAME:
-            name = struct.unpack(f'{data}s', self.file_stream.read(data))[0]
+            name = struct.unpack(f'{data}s', stream.read(data))[0]
 
             return FrameSection(
                 node_name=name.decode('utf-8')
             )
         if section_type is SectionType.GEOMETRY_LIST:
-            n = struct.unpack('<I', self.file_stream.read(4))[0]
+            n = struct.unpack('<I', stream.read(4))[0]
             return GeometryListSection(
                 number_geometry_list=n
             )
         if section_type is SectionType.GEOMETRY:
-            flag_value = struct.unpack('<I', self.file_stream.read(4))[0]
+            flag_value = struct.unpack('<I', stream.read(4))[0]
             flags_set = []
+            prelit = False
 
             if flag_value & rpGEOMETRYPOSITIONS:
                 flags_set.append(rpGEOMETRYPOSITIONS)
@@ -277,69 +402,53 @@ class DffParser:
 
 
             # numMorphTargets всегда равен 1
-            numTriangles, geometryNumVertices,numMorphTarget = struct.unpack('<III', self.file_stream.read(12))
-            # numMorphTarget = struct.unpack('<I', self.file_stream.read(4))[0]
+            numTriangles, geometryNumVertices,numMorphTarget = struct.unpack('<III', stream.read(12))
+            # numMorphTarget = struct.unpack('<I', stream.read(4))[0]
             # print(numTriangles, geometryNumVertices, numMorphTarget)
 
-            prelitcolor_list = []
-            texcords_list = []
-            triangles_list = []
+            prelitcolor = np.empty(0, RW_RGBA)
+            tex_coords = np.empty(0, RW_TEX_COORDS)
+            triangles = np.empty(0, RP_TRIANGLE)
 
             if flag_value & rpGEOMETRYNATIVE == 0:
                 if prelit:
                     # for _ in range(geometryNumVertices):
-                    #     data = struct.unpack(f'4B', self.file_stream.read(4))
+                    #     data = struct.unpack(f'4B', stream.read(4))
                     #     prelitcolor_list.append(
                     #         RwRGBA(data[0],data[1],data[2],data[3])
                     #     )
-                    data = struct.unpack(f'{4 * geometryNumVertices}B', self.file_stream.read(4 * geometryNumVertices))
-                    prelitcolor_list = [
-                       RwRGBA(data[i],data[i+1],data[i+2],data[i+3]) for i in range(0, 4 * geometryNumVertices, 4)
-                    ]
+                    prelitcolor = read_array(stream, RW_RGBA, geometryNumVertices)
 
                 numTexSets = (flag_value & 0x00FF0000) >> 16
 
                 # for _ in range(numTexSets):
                 #     for _ in range(numTriangles):
-                #         data = struct.unpack(f'ff', self.file_stream.read(8))
+                #         data = struct.unpack(f'ff', stream.read(8))
                 #         texcords_list.append(
                 #              RwTexCoords(data[0], data[1])
                 #         )
-                data = struct.unpack(f'{numTexSets * geometryNumVertices * 2}f', self.file_stream.read(numTexSets * geometryNumVertices * 8))
-                texcords_list = [
-                    RwTexCoords(data[i], data[i+1]) for i in range(0, numTexSets * geometryNumVertices * 2, 2)
-                ]
+                tex_coords = read_array(stream, RW_TEX_COORDS, numTexSets * geometryNumVertices)
                 # for _ in range(numTriangles):
-                #     data = struct.unpack(f'HHHH', self.file_stream.read(8))
+                #     data = struct.unpack(f'HHHH', stream.read(8))
                 #     triangles_list.append(
                 #         RpTriangle(data[0], data[1], data[2], data[3])
                 #     )
-                data = struct.unpack(f'{numTriangles * 4}H', self.file_stream.read(numTriangles * 8))
-                triangles_list = [
-                    RpTriangle(data[i], data[i+1], data[i+2], data[i+3]) for i in range(0, numTriangles * 4, 4)
-                ]
+                triangles = read_array(stream, RP_TRIANGLE, numTriangles)
 
 
-            data = struct.unpack(f'4f', self.file_stream.read(16))
+            data = struct.unpack(f'4f', stream.read(16))
             bounding_sphere = RwSphere(x=data[0], y=data[1], z=data[2], radius=data[3])
 
-            has_vertices, has_normals = struct.unpack('II', self.file_stream.read(8))
+            has_vertices, has_normals = struct.unpack('II', stream.read(8))
 
-            vertices = []
-            normals =  []
+            vertices = np.empty(0, RW_V3D)
+            normals = np.empty(0, RW_V3D)
 
             if has_vertices:
-                data = struct.unpack(f'{3 * geometryNumVertices}f', self.file_stream.read(geometryNumVertices * 12))
-                vertices = [
-                    RwV3d(data[i], data[i+1], data[i+2]) for i in range(0, geometryNumVertices * 3, 3)
-                ]
-
+                vertices = read_array(stream, RW_V3D, geometryNumVertices)
 
             if has_normals:
-                data = struct.unpack(f'{3 * geometryNumVertices}f', self.file_stream.read(geometryNumVertices * 12))
-                normals = [
-                    RwV3d(data[i], data[i+1], data[i+2]) for i in range(0, geometryNumVertices * 3, 3)
-                ]
+                normals = read_array(stream, RW_V3D, geometryNumVertices)
 
 
             return GeometrySection(
@@ -355,32 +464,32 @@ class DffParser:
                 vertices=vertices,
                 bounding_sphere=bounding_sphere,
 
-                prelitcolor=prelitcolor_list,
-                triangles=triangles_list,
-                tex_coords=texcords_list
+                prelitcolor=prelitcolor,
+                triangles=triangles,
+                tex_coords=tex_coords
             )
         if section_type is SectionType.MATERIAL_LIST:
-            number_of_materials = struct.unpack('I', self.file_stream.read(4))[0]
-            raw_data = struct.unpack(f'{number_of_materials}I', self.file_stream.read(4 * number_of_materials))
+            number_of_materials = struct.unpack('I', stream.read(4))[0]
+            raw_data = struct.unpack(f'{number_of_materials}I', stream.read(4 * number_of_materials))
 
             return MaterialListSection(
                 number_of_materials=number_of_materials,
                 data=raw_data
             )
         if section_type is SectionType.MATERIAL:
-            flags_material = struct.unpack('<I', self.file_stream.read(4))[0]
+            flags_material = struct.unpack('<I', stream.read(4))[0]
             
             #RwRGBA
-            data = struct.unpack('BBBB', self.file_stream.read(4))
+            data = struct.unpack('BBBB', stream.read(4))
             color = RwRGBA(data[0], data[1], data[2], data[3])
 
             # unsued
-            struct.unpack('<I', self.file_stream.read(4))
+            struct.unpack('<I', stream.read(4))
 
             # IsTextured
-            is_textured  = bool(struct.unpack('<I', self.file_stream.read(4))[0])
+            is_textured  = bool(struct.unpack('<I', stream.read(4))[0])
 
-            ambient, specular, diffuse = struct.unpack('<fff', self.file_stream.read(12))
+            ambient, specular, diffuse = struct.unpack('<fff', stream.read(12))
             return MaterialSection(
                 ambient=ambient,
                 specular=specular,
@@ -390,35 +499,42 @@ class DffParser:
                 is_textured=is_textured
             )
         if section_type is SectionType.TEXTURE:
-            # return self.file_stream.read(4)
-            # texture_filtering, u_addressing, v_addressing = struct.unpack('<2BH', self.file_stream.read(4))
-            # texture_filtering, u_addressing, v_addressing, use_mipmap = struct.unpack('<IIII', self.file_stream.read(16))
-            # texture_filtering, u_addressing, v_addressing, use_mipmap = struct.unpack('IIII', self.file_stream.read(16))
+            # return stream.read(4)
+            # texture_filtering, u_addressing, v_addressing = struct.unpack('<2BH', stream.read(4))
+            # texture_filtering, u_addressing, v_addressing, use_mipmap = struct.unpack('<IIII', stream.read(16))
+            # texture_filtering, u_addressing, v_addressing, use_mipmap = struct.unpack('IIII', stream.read(16))
             # print(texture_filtering, u_addressing, v_addressing, use_mipmap)
-            # name = struct.unpack(f'{data - 40 - 16}s', self.file_stream.read(data - 40 - 16))[0]
+            # name = struct.unpack(f'{data - 40 - 16}s', stream.read(data - 40 - 16))[0]
             # print(len(name), name)
-            return self.file_stream.read(4)
+            return stream.read(4)
         if section_type is SectionType.STRING:
-            name = struct.unpack(f'{data}s', self.file_stream.read(data))[0]
+            name = struct.unpack(f'{data}s', stream.read(data))[0]
             return StringSection(
                 name=name.decode('utf-8')
             )
         if section_type is SectionType.BREAKABLE:
-            name = struct.unpack(f'<I', self.file_stream.read(data))[0]
+            name = struct.unpack(f'<I', stream.read(4))[0]
             return BreakableSection(
                 magic_number=name
             )
         if section_type is SectionType.BIN_MESH_PLG:
-            flags, numMeshes, totalNumber = struct.unpack('<III', self.file_stream.read(12))
+            flags, numMeshes, totalNumber = struct.unpack('<III', stream.read(12))
 
+            # data - размер секции. Обычно индексы uint32, у native геометрии (OpenGL)
+            # uint16, у PS2 индексов нет вовсе: определяем по месту, которое осталось под них
+            index_dtype = BIN_MESH_INDEX_32
+            if data is not None and totalNumber:
+                index_size = (data - 12 - 8 * numMeshes) // totalNumber
+                index_dtype = BIN_MESH_INDEX_32 if index_size >= 4 else BIN_MESH_INDEX_16 if index_size >= 2 else None
 
             list_meshes = []
             for i in range(numMeshes):
-                numOfIndices, materialIndex = struct.unpack('<II', self.file_stream.read(8))
-                indices = []
-                for j in range(numOfIndices):
-                    indices.append(struct.unpack('<I', self.file_stream.read(4))[0])
-                
+                numOfIndices, materialIndex = struct.unpack('<II', stream.read(8))
+                if index_dtype is None:
+                    indices = np.empty(0, BIN_MESH_INDEX_32)
+                else:
+                    indices = read_array(stream, index_dtype, numOfIndices)
+
                 list_meshes.append(
                     {
                         'number_of_indices': numOfIndices,
@@ -434,11 +550,11 @@ class DffParser:
                 list_meshes=list_meshes
             )
         if section_type is SectionType.EXTRA_VERT_COLOUR:
-            magic_number = struct.unpack('<I', self.file_stream.read(4))[0]
+            magic_number = struct.unpack('<I', stream.read(4))[0]
             night_vert_colours = []
 
             if magic_number > 0:
-                p = struct.unpack(f'{4*data}B', self.file_stream.read(4*data))
+                p = struct.unpack(f'{4*data}B', stream.read(4*data))
                 night_vert_colours = [
                     RwRGBA(p[i], p[i+1], p[i+2], p[i+3]) for i in range(0, 4*data, 4)
                 ]
@@ -448,122 +564,427 @@ class DffParser:
                 night_vert_color=night_vert_colours
             )
         if section_type is SectionType.ATOMIC:
-            frame_index, geometryIndex, flags,_ = struct.unpack('<4I', self.file_stream.read(16))
+            frame_index, geometryIndex, flags,_ = struct.unpack('<4I', stream.read(16))
             return AtomicStruct(
                 frame_index=frame_index,
                 geometry_index=geometryIndex,
                 flags=flags
             )
         if section_type is SectionType.TWOD_EFFECT:
-            # pos = struct.unpack('fff', self.file_stream.read(12))
-            # entry_type = struct.unpack('I', self.file_stream.read(4))
-            # data_size = struct.unpack('I', self.file_stream.read(4))
+            # pos = struct.unpack('fff', stream.read(12))
+            # entry_type = struct.unpack('I', stream.read(4))
+            # data_size = struct.unpack('I', stream.read(4))
             # print(pos, entry_type, data_size)
             ...
+    def iter_sections(self):
+        """
+        Yields (SectionType, body) for every known section in file order.
+        Struct chunks are reported with the type of their parent (CLUMP,
+        GEOMETRY, MATERIAL, ...), unknown sections and their children are
+        skipped as a whole.
+        """
+        walker = ChunkWalker(self.file_stream.buffer, DFF_CONTAINERS, self.file_stream.tell())
+        num_vertices = 0
+        for chunk_type, size, version, payload in walker:
+            if chunk_type == SectionType.STRUCT.value:
+                section_type = SECTION_TYPES.get(walker.parent)
+            else:
+                section_type = SECTION_TYPES.get(chunk_type)
+            if section_type is None or (section_type.value in DFF_CONTAINERS and chunk_type != SectionType.STRUCT.value):
+                continue
+
+            stream = BufferStream(payload)
+            data = num_vertices if section_type is SectionType.EXTRA_VERT_COLOUR else len(payload)
+            body = self.get_body(section_type, data, stream)
+            stream.close()
+
+            if section_type is SectionType.GEOMETRY:
+                num_vertices = body.num_of_vertices
+            yield section_type, body
+
+    def get_texture_names(self) -> list[tuple[str, str]]:
+        # (имя текстуры, имя маски) для каждой Texture в материалах
+        walker = ChunkWalker(self.file_stream.buffer, TEXTURE_NAME_CONTAINERS, self.file_stream.tell())
+        textures = []
+        names = []
+        for chunk_type, size, version, payload in walker:
+            if chunk_type == SectionType.STRING.value and walker.parent == SectionType.TEXTURE.value:
+                names.append(bytes(payload).split(b'\x00', 1)[0].decode('utf-8', errors='replace'))
+                if len(names) == 2:
+                    textures.append((names[0], names[1]))
+                    names = []
+        return textures
+
     def __enter__(self):
-        self.file_stream = open(self.file, 'rb')
+        self.file_stream, self._owns_stream = open_stream(self.file)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.file_stream.close()
+        if self._owns_stream:
+            self.file_stream.close()
 
 
-def main() -> None:
-    # # izbushka_psx
-    # korobka
-    with DffParser('./dff_files/izbushka_psx.dff') as f:
-        data = f.get_struct()
-        print(data)
-        print(f.get_body(data.section_type))
-
-        frame_list_section = f.get_struct()
-        print(frame_list_section)
-        frame_list = f.get_body(frame_list_section.section_type)
-        print(frame_list)
-
-        for i in range(frame_list.frame_count):
-            data = f.get_struct()
-            print(data)
-            print(f.get_body(data.section_type, data.size))
-
-        geometry_list = f.get_struct()
-        print(geometry_list)
-        print(f.get_body(geometry_list.section_type))
-
-        data = f.get_struct()
-        print(data)
-        geometry_data: GeometrySection = f.get_body(data.section_type)
-        # print(geometry_data)
-
-        data = f.get_struct()
-        # print(material_list_data)
-        material_list_data = f.get_body(data.section_type)
-        # print(material_list_data)
-        for i in range(material_list_data.number_of_materials):
-            # if data.section_type is SectionType.MATERIAL:
-                # print(material_data)
-            data = f.get_struct()
-            print(data)
-            material_data = f.get_body(data.section_type)
-            print(material_data)
-
-            data = f.get_struct()
-            print(data)
-            texture_data = f.get_body(data.section_type, data.size_2)
-            print(texture_data)
-
-            data = f.get_struct()
-            print(data)
-            string_name = f.get_body(data.section_type, data.size)
-            data = f.get_struct()
-            print(data)
-            mask_name = f.get_body(data.section_type, data.size)
-            print(string_name, mask_name)
-
-            print(f.get_struct())
-            # else:
-                # data = f.get_struct()
-            
+# флаги, число треугольников, вершин и morph target в начале Struct геометрии
+GEOMETRY_HEADER = struct.Struct('<4I')
+RW_SPHERE = struct.Struct('<4f')
+
 
-            # data = f.get_struct()
-            # print(data)
-            # mask_name = f.get_body(data.section_type, data.size)
-            # print(mask_name)
+@dataclass
+class GeometryChunks:
+    # (начало, конец) данных секций одной геометрии в буфере файла
+    struct: tuple[int, int]
+    material_list: tuple[int, int] | None = None
+    # по материалу: {'struct', 'texture', 'strings': [имя, маска]}
+    materials: list[dict] = field(default_factory=list)
+    bin_mesh: tuple[int, int] | None = None
+    breakable: tuple[int, int] | None = None
+    night_colors: tuple[int, int] | None = None
 
-        data = f.get_struct()
-        print(data)
-        bin_meshes = f.get_body(data.section_type)
-        print(bin_meshes)
-        # exit()
 
-        data = f.get_struct()
-        print(data)
-        breakable = f.get_body(data.section_type, data.size)
-        print(breakable)
+@dataclass
+class GeometryLayout:
+    # абсолютные смещения массивов в буфере файла, None если массива нет
+    flags: int
+    num_triangles: int
+    num_vertices: int
+    num_tex_sets: int
+    prelit: int | None
+    tex_coords: int | None
+    triangles: int | None
+    bounding_sphere: int
+    vertices: int | None
+    normals: int | None
 
-        data = f.get_struct()
-        print(data)
-        
-        extra_vert_colour: ExtraVertColourSection = f.get_body(data.section_type, geometry_data.num_of_vertices)
-        # print(extra_vert_colour.night_vert_color)
-        # print(extra_vert_colour)
-        # print(extra_vert_colour)
-        # print(extra_vert_colour)
-
-        data = f.get_struct()
-        print(data)
-        atomic_data = f.get_body(data.section_type)
-        print(atomic_data)
-
-        data = f.get_struct()
-        print(data)
-        data = f.get_struct()
-        if data is None:
-            print('Готово')
-        # data = f.get_struct()
-        # print(data)
-        # print(texture_data)
-        # print(f.get_struct())
+
+@dataclass
+class GeometryPool:
+    """
+    Arrays of all geometries of a model packed into one buffer. Geometry i
+    owns vertices vertex_offsets[i]:vertex_offsets[i + 1] and triangles
+    triangle_offsets[i]:triangle_offsets[i + 1], triangle indices are local
+    to their geometry. Only the first UV set is pooled, absent normals,
+    UVs and prelit colours are left zeroed.
+    """
+    buffer: np.ndarray
+    vertex_offsets: np.ndarray
+    triangle_offsets: np.ndarray
+    flags: np.ndarray
+    has_normals: np.ndarray
+    has_prelit: np.ndarray
+    vertices: np.ndarray
+    normals: np.ndarray
+    tex_coords: np.ndarray
+    triangles: np.ndarray
+    prelitcolor: np.ndarray
+
+    def __len__(self):
+        return len(self.flags)
+
+    def get_geometry(self, index) -> dict[str, np.ndarray]:
+        vertices = slice(self.vertex_offsets[index], self.vertex_offsets[index + 1])
+        return {
+            'vertices': self.vertices[vertices],
+            'normals': self.normals[vertices],
+            'tex_coords': self.tex_coords[vertices],
+            'prelitcolor': self.prelitcolor[vertices],
+            'triangles': self.triangles[self.triangle_offsets[index]:self.triangle_offsets[index + 1]],
+        }
+
+
+class DffModel(DffParser):
+    """
+    DFF opened for on-demand access. open() walks the chunk headers once
+    and records where every section lives; properties decode their
+    sections only when first accessed and cache the result, so asking for
+    bounding spheres or texture names never touches vertex data.
+
+    The file stays mapped until close(), decoded NumPy arrays reference it.
+    """
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        self.file_stream = None
+        self._reset()
+
+    def _reset(self):
+        # повторное открытие индексирует файл заново, разобранные секции сбрасываются
+        for cls in type(self).__mro__:
+            for name, value in vars(cls).items():
+                if isinstance(value, cached_property):
+                    self.__dict__.pop(name, None)
+
+        self.clump_chunk = None
+        self.frame_list_chunk = None
+        # имя кадра из расширения Frame List, None если у кадра его нет
+        self.frame_name_chunks: list[tuple[int, int] | None] = []
+        self.geometry_list_chunk = None
+        self.geometry_chunks: list[GeometryChunks] = []
+        self.atomic_chunks: list[tuple[int, int]] = []
+
+    @classmethod
+    def open(cls, file_name) -> 'DffModel':
+        return cls(file_name).__enter__()
+
+    def close(self):
+        self.__exit__(None, None, None)
+
+    def __enter__(self):
+        # open() уже открыл файл, with DffModel.open(...) его не переоткрывает
+        if self.file_stream is None:
+            self._reset()
+            super().__enter__()
+            try:
+                self._index_chunks()
+            except Exception:
+                self.close()
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.file_stream is not None:
+            super().__exit__(exc_type, exc_val, exc_tb)
+            self.file_stream = None
+
+    def _index_chunks(self):
+        walker = ChunkWalker(self.file_stream.buffer, DFF_CONTAINERS, self.file_stream.tell())
+        for chunk_type, size, version, payload in walker:
+            start = walker.offset + CHUNK_HEADER.size
+            location = (start, start + len(payload))
+            parent = walker.parent
+
+            if parent is None and chunk_type not in DFF_TOP_LEVEL_SECTIONS:
+                raise ValueError(f'Not a DFF: unexpected top-level chunk 0x{chunk_type:x} at {walker.offset}')
+            if chunk_type == SectionType.STRUCT.value:
+                if parent == SectionType.CLUMP.value:
+                    self.clump_chunk = location
+                elif parent == SectionType.FRAME_LIST.value:
+                    self.frame_list_chunk = location
+                elif parent == SectionType.GEOMETRY_LIST.value:
+                    self.geometry_list_chunk = location
+                elif parent == SectionType.GEOMETRY.value:
+                    self.geometry_chunks.append(GeometryChunks(location))
+                elif parent == SectionType.MATERIAL_LIST.value and self.geometry_chunks:
+                    self.geometry_chunks[-1].material_list = location
+                elif parent == SectionType.MATERIAL.value and self.geometry_chunks:
+                    self.geometry_chunks[-1].materials.append({'struct': location, 'texture': None, 'strings': []})
+                elif parent == SectionType.TEXTURE.value and self.geometry_chunks and self.geometry_chunks[-1].materials:
+                    self.geometry_chunks[-1].materials[-1]['texture'] = location
+                elif parent == SectionType.ATOMIC.value:
+                    self.atomic_chunks.append(location)
+            elif chunk_type == SectionType.EXTENSION.value and parent == SectionType.FRAME_LIST.value:
+                self.frame_name_chunks.append(None)
+            elif chunk_type == SectionType.FRAME.value and self.frame_name_chunks:
+                self.frame_name_chunks[-1] = location
+            elif chunk_type == SectionType.STRING.value and parent == SectionType.TEXTURE.value:
+                if self.geometry_chunks and self.geometry_chunks[-1].materials:
+                    self.geometry_chunks[-1].materials[-1]['strings'].append(location)
+            elif chunk_type == SectionType.BIN_MESH_PLG.value and self.geometry_chunks:
+                self.geometry_chunks[-1].bin_mesh = location
+            elif chunk_type == SectionType.BREAKABLE.value and self.geometry_chunks:
+                self.geometry_chunks[-1].breakable = location
+            elif chunk_type == SectionType.EXTRA_VERT_COLOUR.value and self.geometry_chunks:
+                self.geometry_chunks[-1].night_colors = location
+
+        if self.clump_chunk is None:
+            raise ValueError('Not a DFF: no Clump')
+
+    def _view(self, location) -> memoryview:
+        start, end = location
+        return self.file_stream.buffer[start:end]
+
+    def _decode(self, section_type: SectionType, location, data=None):
+        if location is None:
+            return None
+        stream = BufferStream(self._view(location))
+        body = self.get_body(section_type, len(stream.buffer) if data is None else data, stream)
+        stream.close()
+        return body
+
+    def _geometry_header(self, index) -> tuple[int, int, int, int]:
+        # (флаги, треугольников, вершин, morph target) без разбора всей геометрии
+        return GEOMETRY_HEADER.unpack_from(self.file_stream.buffer, self.geometry_chunks[index].struct[0])
+
+    @cached_property
+    def geometry_headers(self) -> np.ndarray:
+        # (флаги, треугольников, вершин, morph target) каждой геометрии, shape (n, 4)
+        return np.array([self._geometry_header(i) for i in range(len(self.geometry_chunks))], np.uint32).reshape(-1, 4)
+
+    @cached_property
+    def clump(self) -> ClumpSection | None:
+        return self._decode(SectionType.CLUMP, self.clump_chunk)
+
+    @cached_property
+    def frame_list(self) -> FrameListSection | None:
+        return self._decode(SectionType.FRAME_LIST, self.frame_list_chunk)
+
+    @cached_property
+    def frames(self) -> list[FrameSection | None]:
+        return [self._decode(SectionType.FRAME, location) for location in self.frame_name_chunks]
+
+    @cached_property
+    def geometries(self) -> list[GeometrySection]:
+        return [self._decode(SectionType.GEOMETRY, chunks.struct) for chunks in self.geometry_chunks]
+
+    @cached_property
+    def materials(self) -> list[list[MaterialSection]]:
+        # материалы каждой геометрии
+        return [
+            [self._decode(SectionType.MATERIAL, material['struct']) for material in chunks.materials]
+            for chunks in self.geometry_chunks
+        ]
+
+    @cached_property
+    def texture_names(self) -> list[list[tuple[str, str] | None]]:
+        # (имя текстуры, имя маски) для каждого материала каждой геометрии, None без текстуры
+        def names(material):
+            if len(material['strings']) < 2:
+                return None
+            return tuple(
+                bytes(self._view(location)).split(b'\x00', 1)[0].decode('utf-8', errors='replace')
+                for location in material['strings'][:2]
+            )
+
+        return [[names(material) for material in chunks.materials] for chunks in self.geometry_chunks]
+
+    @cached_property
+    def bin_meshes(self) -> list[BinMeshPLGSection | None]:
+        return [self._decode(SectionType.BIN_MESH_PLG, chunks.bin_mesh) for chunks in self.geometry_chunks]
+
+    @cached_property
+    def breakables(self) -> list[BreakableSection | None]:
+        return [self._decode(SectionType.BREAKABLE, chunks.breakable) for chunks in self.geometry_chunks]
+
+    @cached_property
+    def night_colors(self) -> list[ExtraVertColourSection | None]:
+        return [
+            self._decode(SectionType.EXTRA_VERT_COLOUR, chunks.night_colors, self._geometry_header(i)[2])
+            for i, chunks in enumerate(self.geometry_chunks)
+        ]
+
+    @cached_property
+    def atomics(self) -> list[AtomicStruct]:
+        return [self._decode(SectionType.ATOMIC, location) for location in self.atomic_chunks]
+
+    def _geometry_layout(self, index) -> GeometryLayout:
+        # Смещения массивов в Struct геометрии считаются по заголовку, без чтения данных
+        flags, num_triangles, num_vertices, _ = self._geometry_header(index)
+        start, end = self.geometry_chunks[index].struct
+        num_tex_sets = (flags & 0x00FF0000) >> 16
+        prelit = tex_coords = triangles = None
+
+        offset = start + GEOMETRY_HEADER.size
+        if flags & rpGEOMETRYNATIVE == 0:
+            if flags & rpGEOMETRYPRELIT:
+                prelit = offset
+                offset += num_vertices * RW_RGBA.itemsize
+            tex_coords = offset
+            offset += num_tex_sets * num_vertices * RW_TEX_COORDS.itemsize
+            triangles = offset
+            offset += num_triangles * RP_TRIANGLE.itemsize
+
+        bounding_sphere = offset
+        offset += RW_SPHERE.size
+        has_vertices, has_normals = struct.unpack_from('<II', self.file_stream.buffer, offset)
+        offset += 8
+        vertices = normals = None
+        if has_vertices:
+            vertices = offset
+            offset += num_vertices * RW_V3D.itemsize
+        if has_normals:
+            normals = offset
+            offset += num_vertices * RW_V3D.itemsize
+        if offset > end:
+            raise ValueError(f'Geometry {index} is truncated: {offset - start} > {end - start}')
+
+        return GeometryLayout(
+            flags, num_triangles, num_vertices, num_tex_sets,
+            prelit, tex_coords, triangles, bounding_sphere, vertices, normals
+        )
+
+    @cached_property
+    def bounding_spheres(self) -> list[RwSphere]:
+        # сфера лежит сразу за prelit, UV и треугольниками, ее смещение считается по заголовку
+        return [
+            RwSphere(*RW_SPHERE.unpack_from(self.file_stream.buffer, self._geometry_layout(i).bounding_sphere))
+            for i in range(len(self.geometry_chunks))
+        ]
+
+    @cached_property
+    def world_matrices(self) -> np.ndarray:
+        if self.frame_list is None:
+            return np.zeros((0, 4, 4), np.float32)
+        return self.frame_list.world_matrices()
+
+    def get_world_vertices(self, atomic_index) -> np.ndarray:
+        # вершины геометрии атомика в мировых координатах, (n, 3) float32
+        atomic = self.atomics[atomic_index]
+        geometry = self.geometry_pool.get_geometry(atomic.geometry_index)
+        return transform_points(geometry['vertices'], self.world_matrices[atomic.frame_index])
+
+    @cached_property
+    def geometry_pool(self) -> GeometryPool:
+        # Все геометрии в общих массивах одного буфера, данные копируются из файла один раз
+        layouts = [self._geometry_layout(i) for i in range(len(self.geometry_chunks))]
+        vertex_offsets = np.zeros(len(layouts) + 1, np.int64)
+        triangle_offsets = np.zeros(len(layouts) + 1, np.int64)
+        vertex_offsets[1:] = np.cumsum([layout.num_vertices for layout in layouts])
+        triangle_offsets[1:] = np.cumsum([layout.num_triangles for layout in layouts])
+        num_vertices, num_triangles = int(vertex_offsets[-1]), int(triangle_offsets[-1])
+
+        # сначала float32, затем uint16 и uint8: каждый массив остается выровненным
+        tables = (
+            ('vertices', RW_V3D, num_vertices), ('normals', RW_V3D, num_vertices),
+            ('tex_coords', RW_TEX_COORDS, num_vertices), ('triangles', RP_TRIANGLE, num_triangles),
+            ('prelitcolor', RW_RGBA, num_vertices),
+        )
+        buffer = np.zeros(sum(dtype.itemsize * count for name, dtype, count in tables), np.uint8)
+        arrays = {}
+        offset = 0
+        for name, dtype, count in tables:
+            arrays[name] = buffer[offset:offset + dtype.itemsize * count].view(dtype)
+            offset += dtype.itemsize * count
+
+        source = self.file_stream.buffer
+        for i, layout in enumerate(layouts):
+            vertices = slice(vertex_offsets[i], vertex_offsets[i + 1])
+            triangles = slice(triangle_offsets[i], triangle_offsets[i + 1])
+            for name, position, target, count in (
+                ('vertices', layout.vertices, vertices, layout.num_vertices),
+                ('normals', layout.normals, vertices, layout.num_vertices),
+                ('tex_coords', layout.tex_coords if layout.num_tex_sets else None, vertices, layout.num_vertices),
+                ('triangles', layout.triangles, triangles, layout.num_triangles),
+                ('prelitcolor', layout.prelit, vertices, layout.num_vertices),
+            ):
+                if position is not None:
+                    arrays[name][target] = np.frombuffer(source, arrays[name].dtype, count, position)
+
+        return GeometryPool(
+            buffer=buffer,
+            vertex_offsets=vertex_offsets,
+            triangle_offsets=triangle_offsets,
+            flags=np.array([layout.flags for layout in layouts], np.uint32),
+            has_normals=np.array([layout.normals is not None for layout in layouts], bool),
+            has_prelit=np.array([layout.prelit is not None for layout in layouts], bool),
+            **arrays
+        )
+
+
+def main() -> None:
+    # # izbushka_psx
+    # korobka
+    with DffModel.open('./dff_files/izbushka_psx.dff') as model:
+        print(model.clump)
+        print(model.frame_list.frame_count if model.frame_list else 0, model.frames)
+        print(f'Геометрий: {len(model.geometry_chunks)}, атомиков: {len(model.atomics)}')
+        if model.clump is not None and model.clump.atomics != len(model.atomics):
+            print(f'В Clump указано атомиков: {model.clump.atomics}')
+
+        pool = model.geometry_pool
+        for i in range(len(pool)):
+            geometry = pool.get_geometry(i)
+            print(i, len(geometry['vertices']), len(geometry['triangles']), model.texture_names[i], model.bounding_spheres[i])
+        print(model.atomics)
+        print('Готово')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,188 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from dff_parser import DffModel
+from img_archive import ImgArchive, get_shared_archive
+
+
+# сколько моделей обрабатывает воркер за одну задачу
+SCAN_CHUNK_SIZE = 64
+
+# одна запись на модель, имена и текстуры лежат отдельными списками
+DFF_SCAN_RECORD = np.dtype([
+    ('file_size', '<u4'),
+    ('clump_atomics', '<u4'),
+    ('atomics', '<u4'),
+    ('frames', '<u4'),
+    ('geometries', '<u4'),
+    ('materials', '<u4'),
+    ('vertices', '<u8'),
+    ('triangles', '<u8'),
+    ('bin_mesh_indices', '<u8'),
+    # сфера, охватывающая сферы всех геометрий
+    ('bounding_sphere', '<f4', 4),
+])
+
+
+@dataclass
+class DffScanResult:
+    names: list[str] = field(default_factory=list)
+    records: np.ndarray = field(default_factory=lambda: np.empty(0, DFF_SCAN_RECORD))
+    # уникальные имена текстур каждой модели
+    textures: list[tuple[str, ...]] = field(default_factory=list)
+    # (имя файла, текст ошибки)
+    errors: list[tuple[str, str]] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def enclosing_sphere(spheres) -> tuple[float, float, float, float]:
+    # грубая сфера вокруг набора сфер: центр AABB и максимальное расстояние до края
+    if not spheres:
+        return 0.0, 0.0, 0.0, 0.0
+    spheres = np.array([(sphere.x, sphere.y, sphere.z, sphere.radius) for sphere in spheres], np.float64)
+    centers, radii = spheres[:, :3], spheres[:, 3]
+    center = ((centers - radii[:, None]).min(axis=0) + (centers + radii[:, None]).max(axis=0)) / 2
+    radius = (np.linalg.norm(centers - center, axis=1) + radii).max()
+    return (*center, radius)
+
+
+def scan_model(model: DffModel, record, full=False):
+    # Заполняет запись DFF_SCAN_RECORD, возвращает имена текстур модели
+    headers = model.geometry_headers
+    record['clump_atomics'] = model.clump.atomics if model.clump is not None else 0
+    record['atomics'] = len(model.atomic_chunks)
+    record['frames'] = model.frame_list.frame_count if model.frame_list is not None else 0
+    record['geometries'] = len(headers)
+    record['materials'] = sum(len(chunks.materials) for chunks in model.geometry_chunks)
+    record['triangles'] = headers[:, 1].sum(dtype=np.uint64)
+    record['vertices'] = headers[:, 2].sum(dtype=np.uint64)
+    record['bounding_sphere'] = enclosing_sphere(model.bounding_spheres)
+
+    if full:
+        # полный разбор: геометрия, меши и кадры, чтобы найти битые файлы
+        model.geometry_pool
+        model.world_matrices
+        record['bin_mesh_indices'] = sum(
+            bin_mesh.total_number_of_indices for bin_mesh in model.bin_meshes if bin_mesh is not None
+        )
+
+    names = dict.fromkeys(
+        names[0] for geometry_names in model.texture_names for names in geometry_names if names and names[0]
+    )
+    return tuple(names)
+
+
+# - Воркер ------------------------------------------------------------
+
+def _scan_chunk(img_path, names, full):
+    records = np.zeros(len(names), DFF_SCAN_RECORD)
+    ok = np.zeros(len(names), bool)
+    textures = []
+    errors = []
+    for i, name in enumerate(names):
+        data = None
+        try:
+            if img_path is None:
+                source = name
+                records[i]['file_size'] = os.path.getsize(name)
+            else:
+                source = data = get_shared_archive(img_path).get_data(name)
+                records[i]['file_size'] = len(data)
+            with DffModel.open(source) as model:
+                textures.append(scan_model(model, records[i], full))
+            ok[i] = True
+        except Exception as ex:
+            errors.append((name, f'{type(ex).__name__}: {ex}'))
+        finally:
+            if data is not None:
+                data.release()
+    return [name for name, good in zip(names, ok) if good], records[ok], textures, errors
+
+
+# - Родительский процесс ----------------------------------------------
+
+def iter_dff_names(source) -> tuple[str | None, list[str]]:
+    # (путь IMG архива или None, имена файлов или записей архива)
+    extension = os.path.splitext(source)[1].lower()
+    if extension in ('.img', '.dir') and os.path.isfile(source):
+        with ImgArchive(source) as archive:
+            return source, [entry.name for entry in archive.get_entries_by_extension('dff')]
+    if os.path.isdir(source):
+        source = os.path.join(source, '**', '*.[dD][fF][fF]')
+    return None, sorted(glob.glob(source, recursive=True))
+
+
+def scan(source, workers=None, full=False, chunk_size=SCAN_CHUNK_SIZE, on_chunk=None) -> DffScanResult:
+    """
+    Scans every DFF of a directory, glob pattern or IMG archive on a
+    process pool. Workers get only file or entry names and send back one
+    DFF_SCAN_RECORD array per chunk, so no dataclasses are pickled.
+    Files that fail to parse are listed in errors and the run continues.
+    """
+    img_path, names = iter_dff_names(source)
+    result = DffScanResult()
+    batches = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_scan_chunk, img_path, names[i:i + chunk_size], full)
+            for i in range(0, len(names), chunk_size)
+        ]
+        # в порядке отправки, чтобы результат не зависел от планировщика
+        for future in futures:
+            chunk_names, records, textures, errors = future.result()
+            result.names += chunk_names
+            batches.append(records)
+            result.textures += textures
+            result.errors += errors
+            if on_chunk is not None:
+                on_chunk(len(chunk_names) + len(errors), len(names))
+
+    if batches:
+        result.records = np.concatenate(batches)
+    return result
+
+
+def save_result(result: DffScanResult, path):
+    np.savez_compressed(
+        path,
+        names=np.array(result.names),
+        records=result.records,
+        textures=np.array(['\n'.join(names) for names in result.textures]),
+        errors=np.array(result.errors, dtype=str).reshape(-1, 2)
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Пакетный разбор DFF')
+    parser.add_argument('source', help='папка, glob или IMG архив')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='количество процессов')
+    parser.add_argument('--full', action='store_true', help='разбирать геометрию, меши и кадры целиком')
+    parser.add_argument('-o', '--output', default=None, help='сохранить результаты в .npz')
+    args = parser.parse_args()
+
+    result = scan(args.source, args.jobs, args.full)
+    for name, error in result.errors:
+        print(error, f'File: {name}')
+
+    records = result.records
+    print(f'Моделей: {len(result)}, ошибок: {len(result.errors)}')
+    print(f'Геометрий: {records["geometries"].sum()}, вершин: {records["vertices"].sum()}, '
+          f'треугольников: {records["triangles"].sum()}')
+    mismatched = np.flatnonzero(records['clump_atomics'] != records['atomics'])
+    for i in mismatched:
+        print(f'{result.names[i]}: в Clump {records["clump_atomics"][i]} атомиков, в файле {records["atomics"][i]}')
+
+    if args.output is not None:
+        save_result(result, args.output)
+
+
+if __name__ == '__main__':
+    main()
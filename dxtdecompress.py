@@ -10,7 +10,8 @@ import struct
 from enum import Enum
 from PIL import Image
 from struct import unpack_from
-import json
+from functools import lru_cache
+import numpy as np
 
 def make_fourcc(ch1, ch2, ch3, ch4):
     return (ord(ch1) & 0xFF) | ((ord(ch2) & 0xFF) << 8) | ((ord(ch3) & 0xFF) << 16) | ((ord(ch4) & 0xFF) << 24)
@@ -376,6 +377,297 @@ class ImageDecoder:
 
         return bytes(ret)
 
+BC1_BLOCK = np.dtype([('color0', '<u2'), ('color1', '<u2'), ('bits', '<u4')])
+BC2_BLOCK = np.dtype([('alpha_bits', '<u8'), ('color0', '<u2'), ('color1', '<u2'), ('bits', '<u4')])
+BC3_BLOCK = np.dtype([
+    ('alpha0', 'u1'), ('alpha1', 'u1'), ('alpha_bits', '<u2', (3,)),
+    ('color0', '<u2'), ('color1', '<u2'), ('bits', '<u4')
+])
+
+# веса интерполяции альфы BC3, посчитанные так же как в ImageDecoder.bc3
+BC3_ALPHA_WEIGHTS_8 = np.array([(6 / 7, 1 / 7), (5 / 7, 2 / 7), (4 / 7, 3 / 7), (3 / 7, 4 / 7), (2 / 7, 5 / 7), (1 / 7, 6 / 7)])
+BC3_ALPHA_WEIGHTS_6 = np.array([(4 / 5, 1 / 5), (3 / 5, 2 / 5), (2 / 5, 3 / 5), (1 / 5, 4 / 5)])
+
+
+# 16-битные форматы: (сдвиг, число бит) для r, g, b, a; None - альфа 0xff
+PACKED_16_FORMATS = {
+    '1555': ((10, 5), (5, 5), (0, 5), (15, 1)),
+    '4444': ((8, 4), (4, 4), (0, 4), (12, 4)),
+    '555':  ((10, 5), (5, 5), (0, 5), None),
+    '565':  ((11, 5), (5, 6), (0, 5), None),
+}
+
+# побайтовые форматы: (байт на пиксель, номера байт для r, g, b, a); None - альфа 0xff
+BYTE_FORMATS = {
+    '888':    (4, (2, 1, 0, None)),
+    '8888':   (4, (2, 1, 0, 3)),
+    'lum8':   (1, (0, 0, 0, None)),
+    'lum8a8': (2, (0, 0, 0, 1)),
+}
+
+
+@lru_cache(maxsize=None)
+def packed_16_table(format_name):
+    # все 65536 значений -> упакованный RGBA uint32, конвертация становится одним take
+    values = np.arange(0x10000, dtype=np.uint32)
+    table = np.zeros(0x10000, dtype=np.uint32)
+    for channel, field in enumerate(PACKED_16_FORMATS[format_name]):
+        if field is None:
+            component = np.uint32(0xff)
+        else:
+            shift, bits = field
+            mask = (1 << bits) - 1
+            component = ((values >> shift) & mask) * 0xff // mask
+        table |= component << np.uint32(8 * channel)
+    return table
+
+
+class NumpyImageDecoder:
+    """
+    Whole-image NumPy versions of ImageDecoder. Every method decodes all
+    blocks/pixels at once and returns a (height, width, 4) uint8 RGBA array,
+    .tobytes() of it is identical to the ImageDecoder output.
+    """
+
+    @staticmethod
+    def _decode565(bits):
+        bits = bits.astype(np.uint16)
+        a = ((bits >> 11) & 0x1f) * 0xff // 0x1f
+        b = ((bits >> 5) & 0x3f) * 0xff // 0x3f
+        c = (bits & 0x1f) * 0xff // 0x1f
+        return np.stack((a, b, c), axis=-1)
+
+    @staticmethod
+    def _blocks(data, dtype, width, height):
+        count = ((width + 3) // 4) * ((height + 3) // 4)
+        return np.frombuffer(data, dtype=dtype, count=count)
+
+    @staticmethod
+    def _unblock(texels, width, height):
+        # (блоки, 16) упакованных RGBA uint32 -> (height, width, 4) uint8
+        blocks_x, blocks_y = (width + 3) // 4, (height + 3) // 4
+        image = texels.reshape(blocks_y, blocks_x, 4, 4).transpose(0, 2, 1, 3)
+        image = image.reshape(blocks_y * 4, blocks_x * 4)[:height, :width]
+        return np.ascontiguousarray(image).view(np.uint8).reshape(height, width, 4)
+
+    @staticmethod
+    def _pack_rgb(rgb):
+        # (..., 3) -> упакованный uint32 с нулевой альфой
+        rgb = rgb.astype(np.uint32)
+        return rgb[..., 0] | (rgb[..., 1] << 8) | (rgb[..., 2] << 16)
+
+    @staticmethod
+    def _color_palette(color0, color1):
+        # (блоки, 4) упакованных RGB без альфы и признак 4-цветного режима
+        c0 = NumpyImageDecoder._decode565(color0)
+        c1 = NumpyImageDecoder._decode565(color1)
+        four_colors = color0 > color1
+        pack = NumpyImageDecoder._pack_rgb
+
+        palette = np.empty((len(color0), 4), dtype=np.uint32)
+        palette[:, 0] = pack(c0)
+        palette[:, 1] = pack(c1)
+        palette[:, 2] = np.where(four_colors, pack((2 * c0 + c1) // 3), pack((c0 + c1) // 2))
+        palette[:, 3] = np.where(four_colors, pack((2 * c1 + c0) // 3), 0)
+        return palette, four_colors
+
+    @staticmethod
+    def _lookup(palette, bits, index_bits):
+        # palette (блоки, 2**index_bits), bits - упакованные индексы 16 текселей блока
+        count = palette.shape[1]
+        bits = np.ascontiguousarray(bits)
+        shifts = np.arange(0, 16 * index_bits, index_bits, dtype=bits.dtype)
+        flat = (bits[:, None] >> shifts) & bits.dtype.type(count - 1)
+        flat |= (np.arange(len(bits), dtype=bits.dtype) * bits.dtype.type(count))[:, None]
+        return np.take(palette.ravel(), flat)
+
+    @staticmethod
+    def bc1(data, width, height, alpha_flag):
+        blocks = NumpyImageDecoder._blocks(data, BC1_BLOCK, width, height)
+        colors, four_colors = NumpyImageDecoder._color_palette(blocks['color0'], blocks['color1'])
+
+        alpha = np.uint32(0xff | alpha_flag) << 24
+        palette = colors | alpha
+        # в 3-цветном режиме цвет с индексом 3 - прозрачный черный
+        palette[~four_colors, 3] = np.uint32(alpha_flag) << 24
+
+        texels = NumpyImageDecoder._lookup(palette, blocks['bits'], 2)
+        return NumpyImageDecoder._unblock(texels, width, height)
+
+    @staticmethod
+    def _unpremultiply(image):
+        # r = min(round(r * 255 / a), 255) для a > 0, round с банковским округлением как в Python
+        alpha = image[..., 3:4]
+        mask = alpha[..., 0] > 0
+        rgb = image[..., :3][mask].astype(np.float64) * 255 / alpha[mask]
+        image[..., :3][mask] = np.minimum(np.round(rgb), 255).astype(np.uint8)
+        return image
+
+    @staticmethod
+    def bc2(data, width, height, premultiplied):
+        blocks = NumpyImageDecoder._blocks(data, BC2_BLOCK, width, height)
+        colors, _ = NumpyImageDecoder._color_palette(blocks['color0'], blocks['color1'])
+
+        # явная 4-битная альфа, по 4 бита на тексель
+        alpha_bits = np.ascontiguousarray(blocks['alpha_bits'])
+        alpha = (alpha_bits[:, None] >> np.arange(0, 64, 4, dtype=np.uint64)) & np.uint64(0xf)
+        alpha = alpha.astype(np.uint32) * 0x11
+
+        texels = NumpyImageDecoder._lookup(colors, blocks['bits'], 2) | (alpha << 24)
+        image = NumpyImageDecoder._unblock(texels, width, height)
+        if premultiplied:
+            NumpyImageDecoder._unpremultiply(image)
+        return image
+
+    @staticmethod
+    def _convert_packed_16(format_name, data, width, height):
+        pixels = np.frombuffer(data, dtype='<u2', count=width * height)
+        table = packed_16_table(format_name)
+        return np.take(table, pixels).view(np.uint8).reshape(height, width, 4)
+
+    @staticmethod
+    def _convert_bytes(format_name, data, width, height):
+        bytes_per_pixel, channels = BYTE_FORMATS[format_name]
+        pixels = np.frombuffer(data, dtype=np.uint8, count=width * height * bytes_per_pixel)
+        pixels = pixels.reshape(height, width, bytes_per_pixel)
+
+        image = np.empty((height, width, 4), dtype=np.uint8)
+        rgb = list(channels[:3])
+        image[..., :3] = pixels[..., rgb]
+        image[..., 3] = 0xff if channels[3] is None else pixels[..., channels[3]]
+        return image
+
+    @staticmethod
+    def convert(format_name, data, width, height):
+        if format_name in PACKED_16_FORMATS:
+            return NumpyImageDecoder._convert_packed_16(format_name, data, width, height)
+        return NumpyImageDecoder._convert_bytes(format_name, data, width, height)
+
+    @staticmethod
+    def bgra1555(data, width, height):
+        return NumpyImageDecoder.convert('1555', data, width, height)
+
+    @staticmethod
+    def bgra4444(data, width, height):
+        return NumpyImageDecoder.convert('4444', data, width, height)
+
+    @staticmethod
+    def bgra555(data, width, height):
+        return NumpyImageDecoder.convert('555', data, width, height)
+
+    @staticmethod
+    def bgra565(data, width, height):
+        return NumpyImageDecoder.convert('565', data, width, height)
+
+    @staticmethod
+    def bgra888(data, width, height):
+        return NumpyImageDecoder.convert('888', data, width, height)
+
+    @staticmethod
+    def bgra8888(data, width, height):
+        return NumpyImageDecoder.convert('8888', data, width, height)
+
+    @staticmethod
+    def lum8(data, width, height):
+        return NumpyImageDecoder.convert('lum8', data, width, height)
+
+    @staticmethod
+    def lum8a8(data, width, height):
+        return NumpyImageDecoder.convert('lum8a8', data, width, height)
+
+    @staticmethod
+    def palette_indices(data, width, height, depth):
+        # depth 4: два индекса в байте, старший полубайт первым
+        count = width * height
+        if depth == 4:
+            packed = np.frombuffer(data, dtype=np.uint8, count=(count + 1) // 2)
+            indices = np.empty((len(packed), 2), dtype=np.uint8)
+            indices[:, 0] = packed >> 4
+            indices[:, 1] = packed & 0xf
+            return indices.reshape(-1)[:count].reshape(height, width)
+        return np.frombuffer(data, dtype=np.uint8, count=count).reshape(height, width)
+
+    @staticmethod
+    def palette_colors(palette, alpha=True):
+        colors = np.frombuffer(palette, dtype=np.uint8)
+        colors = colors[:len(colors) // 4 * 4].reshape(-1, 4)
+        if not alpha:
+            colors = colors.copy()
+            colors[:, 3] = 0xff
+        return colors
+
+    @staticmethod
+    def _pal(data, palette, width, height, depth, alpha):
+        indices = NumpyImageDecoder.palette_indices(data, width, height, depth)
+        return NumpyImageDecoder.palette_colors(palette, alpha)[indices]
+
+    @staticmethod
+    def pal4(data, palette, width, height):
+        return NumpyImageDecoder._pal(data, palette, width, height, 4, True)
+
+    @staticmethod
+    def pal4_noalpha(data, palette, width, height):
+        return NumpyImageDecoder._pal(data, palette, width, height, 4, False)
+
+    @staticmethod
+    def pal8(data, palette, width, height):
+        return NumpyImageDecoder._pal(data, palette, width, height, 8, True)
+
+    @staticmethod
+    def pal8_noalpha(data, palette, width, height):
+        return NumpyImageDecoder._pal(data, palette, width, height, 8, False)
+
+    @staticmethod
+    def palettized_image(data, palette, width, height, depth, alpha=True) -> Image.Image:
+        # Изображение в режиме P без разворачивания в RGBA
+        indices = NumpyImageDecoder.palette_indices(data, width, height, depth)
+        colors = NumpyImageDecoder.palette_colors(palette, alpha)
+
+        image = Image.frombuffer('P', (width, height), np.ascontiguousarray(indices), 'raw', 'P', 0, 1)
+        if alpha:
+            image.putpalette(colors.tobytes(), rawmode='RGBA')
+        else:
+            image.putpalette(colors[:, :3].tobytes(), rawmode='RGB')
+        return image
+
+    @staticmethod
+    def _bc3_alpha_palette(alpha0, alpha1):
+        a0 = alpha0.astype(np.float64)[:, None]
+        a1 = alpha1.astype(np.float64)[:, None]
+        eight_alphas = alpha0 > alpha1
+
+        palette = np.empty((len(alpha0), 8), dtype=np.uint32)
+        palette[:, 0] = alpha0
+        palette[:, 1] = alpha1
+        interpolated_8 = np.round(a0 * BC3_ALPHA_WEIGHTS_8[:, 0] + a1 * BC3_ALPHA_WEIGHTS_8[:, 1])
+        interpolated_6 = np.round(a0 * BC3_ALPHA_WEIGHTS_6[:, 0] + a1 * BC3_ALPHA_WEIGHTS_6[:, 1])
+        palette[:, 2:] = np.where(
+            eight_alphas[:, None],
+            interpolated_8,
+            np.concatenate((interpolated_6, np.zeros((len(alpha0), 1)), np.full((len(alpha0), 1), 255)), axis=1)
+        )
+        return palette
+
+    @staticmethod
+    def bc3(data, width, height, premultiplied):
+        blocks = NumpyImageDecoder._blocks(data, BC3_BLOCK, width, height)
+        colors, _ = NumpyImageDecoder._color_palette(blocks['color0'], blocks['color1'])
+        alpha_palette = NumpyImageDecoder._bc3_alpha_palette(blocks['alpha0'], blocks['alpha1']) << 24
+
+        # 48-битное поле индексов альфы как uint64
+        words = blocks['alpha_bits'].astype(np.uint64)
+        alpha_bits = words[:, 0] | (words[:, 1] << np.uint64(16)) | (words[:, 2] << np.uint64(32))
+        alpha = NumpyImageDecoder._lookup(alpha_palette, alpha_bits, 3)
+        # ImageDecoder.bc3 берет индексы строк блока в обратном порядке
+        alpha = alpha.reshape(-1, 4, 4)[:, ::-1].reshape(-1, 16)
+
+        texels = NumpyImageDecoder._lookup(colors, blocks['bits'], 2) | alpha
+        image = NumpyImageDecoder._unblock(texels, width, height)
+        if premultiplied:
+            NumpyImageDecoder._unpremultiply(image)
+        return image
+
+
 class D3DFORMAT(Enum):
     D3D_8888 = 21
     D3D_888  = 22
@@ -384,6 +676,7 @@ class D3DFORMAT(Enum):
     D3D_1555 = 25
     D3D_4444 = 26
 
+    D3DFMT_P8   = 41
     D3DFMT_L8   = 50
     D3DFMT_A8L8 = 51
 
@@ -399,56 +692,107 @@ class D3DFORMAT(Enum):
 
 
 
+RASTER_FORMAT_MASK = 0x0f00
+RASTER_FORMAT_EXT_PAL8 = 0x2000
+RASTER_FORMAT_EXT_PAL4 = 0x4000
+# базовые форматы палитры с альфой: 1555, 4444, 8888
+RASTER_FORMATS_WITH_ALPHA = (0x0100, 0x0300, 0x0500)
+
+UNCOMPRESSED_FORMATS = {
+    D3DFORMAT.D3D_8888: '8888',
+    D3DFORMAT.D3D_888: '888',
+    D3DFORMAT.D3D_565: '565',
+    D3DFORMAT.D3D_555: '555',
+    D3DFORMAT.D3D_1555: '1555',
+    D3DFORMAT.D3D_4444: '4444',
+    D3DFORMAT.D3DFMT_L8: 'lum8',
+    D3DFORMAT.D3DFMT_A8L8: 'lum8a8',
+}
+
+
+def decode_texture(raster_meta, data, palette=None) -> Image.Image:
+    """
+    Decodes one raster into a PIL image. raster_meta is the dict returned
+    by txt_parser.parse_raster_header (or its texture_store copy), data is the
+    raster payload. Palettized rasters need the palette and come back as
+    mode 'P' images, everything else as RGBA built straight from the
+    decoded buffer.
+    """
+    width, height = raster_meta['width'], raster_meta['height']
+    raster_format = raster_meta['raster_format']
+    if isinstance(raster_format, str):
+        raster_format = int(raster_format, 16)
+
+    if raster_format & (RASTER_FORMAT_EXT_PAL8 | RASTER_FORMAT_EXT_PAL4):
+        if palette is None:
+            raise ValueError(f'Raster {raster_meta["name"]} is palettized, palette is required')
+        depth = 8 if raster_format & RASTER_FORMAT_EXT_PAL8 else 4
+        alpha = raster_format & RASTER_FORMAT_MASK in RASTER_FORMATS_WITH_ALPHA
+        return NumpyImageDecoder.palettized_image(data, palette, width, height, depth, alpha)
+
+    d3d_format = D3DFORMAT(raster_meta['d3d_format'])
+    if d3d_format is D3DFORMAT.D3DFMT_DXT1:
+        pixels = NumpyImageDecoder.bc1(data, width, height, 0x00)
+    elif d3d_format in (D3DFORMAT.D3DFMT_DXT2, D3DFORMAT.D3DFMT_DXT3):
+        pixels = NumpyImageDecoder.bc2(data, width, height, d3d_format is D3DFORMAT.D3DFMT_DXT2)
+    elif d3d_format in (D3DFORMAT.D3DFMT_DXT4, D3DFORMAT.D3DFMT_DXT5):
+        pixels = NumpyImageDecoder.bc3(data, width, height, d3d_format is D3DFORMAT.D3DFMT_DXT4)
+    elif d3d_format in UNCOMPRESSED_FORMATS:
+        pixels = NumpyImageDecoder.convert(UNCOMPRESSED_FORMATS[d3d_format], data, width, height)
+    else:
+        raise ValueError(f'Unsupported raster format {d3d_format.name}')
+
+    return Image.frombuffer('RGBA', (width, height), pixels, 'raw', 'RGBA', 0, 1)
+
+
+def get_level(raster_meta, payload, level=0):
+    # (данные уровня, ширина, высота, палитра) из данных растра txt_parser.iter_textures
+    levels = raster_meta.get('levels')
+    if not levels:
+        # метаданные из старого json_data.json без уровней: все данные считаются нулевым уровнем
+        return payload, raster_meta['width'], raster_meta['height'], None
+
+    mip = levels[min(level, len(levels) - 1)]
+    data = payload[mip['offset']:mip['offset'] + mip['size']]
+    palette = None
+    if raster_meta.get('palette_size'):
+        palette = payload[raster_meta['palette_offset']:raster_meta['palette_offset'] + raster_meta['palette_size']]
+    return data, mip['width'], mip['height'], palette
+
+
+def pick_level(raster_meta, max_size) -> int:
+    # первый (самый крупный) уровень, который влезает в max_size x max_size
+    levels = raster_meta.get('levels') or []
+    for i, mip in enumerate(levels):
+        if mip['width'] <= max_size and mip['height'] <= max_size:
+            return i
+    return max(len(levels) - 1, 0)
+
+
+def decode_raster_level(raster_meta, payload, level=0) -> Image.Image:
+    # Декодирует только выбранный уровень, например 64x64 для превью вместо 1024x1024
+    data, width, height, palette = get_level(raster_meta, payload, level)
+    return decode_texture(dict(raster_meta, width=width, height=height), data, palette)
+
+
 def main():
-    txd_files = json.loads(open('./json_data.json', 'r', encoding='utf-8').read())
-    for j in txd_files.keys():
-        for file_data in txd_files[j]['textures']:
-            # print(file_data)
-            
-            s3tc_format = D3DFORMAT(file_data['d3d_format'])
-            # print(s3tc_format)
-
-            with open(f'./txd_files_data/{file_data["name"]}.data', 'rb') as f:
-                width = file_data['width']
-                height = file_data['height']
+    from texture_store import TextureStore
+
+    with TextureStore() as store:
+        for j, info, textures in store.iter_txds():
+            for file_data in textures:
+                with open(f'./txd_files_data/{file_data["name"]}.data', 'rb') as f:
+                    data = f.read()
+
                 try:
-                    if s3tc_format is D3DFORMAT.D3DFMT_DXT1:
-                        bytes_data = ImageDecoder.bc1(f.read(), width, height, 0x00)
-                    if s3tc_format is D3DFORMAT.D3DFMT_DXT3:
-                        bytes_data = ImageDecoder.bc2(f.read(), width, height, False)
+                    img = decode_raster_level(file_data, data)
                 except Exception as ex:
                     print(ex, j)
                     continue
-                
-                # bytes_data = buff.DXT1Decompress(f)
 
-                img = Image.new('RGB', (width, height))
-                pixels = img.load()
-                set_pixel_x = 0
-                set_pixel_y = 0
+                img.save(f'./decoded_files/{file_data["name"]}.png')
+                print(f'Image saved as {file_data["name"]}.png')
 
-                try:
-                    for y in range(0, height):
-                        for x in range(0, width):
-                            try:
-                                data = struct.unpack('<4B', bytes_data[set_pixel_y * width + set_pixel_x:set_pixel_y * width + set_pixel_x + 4])
-                            except:
-                                data = (255, 0, 255, 255)
-                            pixels[x,y] = data
-                            set_pixel_x += 4
-
-                        set_pixel_y += 4
-                        set_pixel_x = 0
-
-                    img.save(f'./decoded_files/{file_data["name"]}.png')
-                    print("Image saved as output_image.png")
-                except Exception as ex:
-                    print(ex)
-                    print(len(bytes_data), x, y)
-                    continue
 
-                
-        
-    
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,476 @@
+import fnmatch
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+
+SECTOR_SIZE = 2048
+
+IMG_VERSION_2 = b'VER2'
+# у v1 (GTA III/VC) нет заголовка, маркер только для ImgArchive.version
+IMG_VERSION_1 = b'VER1'
+
+# максимум байт за один вызов copy_file_range/sendfile
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+# сколько записей резервировать в каталоге, когда он упирается в данные
+DIRECTORY_GROWTH = 1024
+
+IMG_HEADER = struct.Struct('<4sI')
+IMG_DIRECTORY_ENTRY = struct.Struct('<IHH24s')
+IMG_V1_DIRECTORY_ENTRY = struct.Struct('<II24s')
+IMG_MAX_NAME_LENGTH = 23
+
+
+@dataclass
+class ImgEntry:
+    offset: int
+    streaming_size: int
+    archive_size: int
+    name: str
+
+    @property
+    def size(self) -> int:
+        # archive_size в SA всегда 0, размер берется из streaming_size
+        return (self.streaming_size or self.archive_size) * SECTOR_SIZE
+
+    @property
+    def byte_offset(self) -> int:
+        return self.offset * SECTOR_SIZE
+
+
+def decode_entry_name(name: bytes) -> str:
+    return name.split(b'\x00', 1)[0].decode('utf-8', errors='replace')
+
+
+def encode_entry_name(name: str) -> bytes:
+    encoded = name.encode('utf-8')
+    if len(encoded) > IMG_MAX_NAME_LENGTH:
+        raise ValueError(f'IMG entry name {name!r} is longer than {IMG_MAX_NAME_LENGTH} bytes')
+    return encoded
+
+
+def sectors_for(size: int) -> int:
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+def find_sibling(path, extension):
+    base = os.path.splitext(path)[0]
+    for candidate in (extension.lower(), extension.upper()):
+        if os.path.exists(base + candidate):
+            return base + candidate
+    return None
+
+
+# Имена в GTA регистронезависимые
+def normalize_name(name: str) -> str:
+    return name.lower()
+
+
+def normalize_extension(extension: str) -> str:
+    extension = extension.lower()
+    if not extension.startswith('.'):
+        extension = '.' + extension
+    return extension
+
+
+def copy_range(source_fd, destination_fd, offset, size, source_view):
+    # копирование внутри ядра, без прохода байт через Python
+    end = offset + size
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(source_fd, destination_fd, min(end - offset, COPY_CHUNK_SIZE), offset)
+                if copied == 0:
+                    return
+                offset += copied
+            return
+        except OSError:
+            pass
+    if hasattr(os, 'sendfile'):
+        try:
+            while offset < end:
+                copied = os.sendfile(destination_fd, source_fd, offset, min(end - offset, COPY_CHUNK_SIZE))
+                if copied == 0:
+                    return
+                offset += copied
+            return
+        except OSError:
+            pass
+
+    # Windows и файловые системы без поддержки: обычная запись из mmap
+    with source_view[offset:end] as data:
+        with open(destination_fd, 'wb', closefd=False) as output:
+            output.write(data)
+
+
+class ImgArchive:
+    """
+    VER2 (.img) archive opened through mmap.
+
+    The whole directory is unpacked in one pass when the archive is opened,
+    entry data is returned as memoryview slices of the mapping, so nothing
+    is copied until the caller asks for it. Views must be released before
+    the archive is closed or remapped after a write.
+
+    Both VER2 and v1 archives are supported. For v1 the directory is read
+    from the .dir file next to the .img, either of them may be passed.
+
+    mode 'r+' opens an existing archive for writing, 'w' creates a new VER2 one.
+    Entries that grow are appended at the end of the file, the directory
+    is written on flush()/close(), and compact() reclaims dead sectors.
+    """
+
+    def __init__(self, file_path, mode='r'):
+        if mode not in ('r', 'r+', 'w'):
+            raise ValueError(f'Invalid IMG archive mode {mode!r}')
+        self.file_path = file_path
+        self.dir_path = None
+        self.mode = mode
+        self.version = None
+        self.entries: list[ImgEntry] = []
+        self.entries_by_name: dict[str, ImgEntry] = {}
+        self.entries_by_extension: dict[str, list[ImgEntry]] = {}
+
+        self.file_stream = None
+        self._mmap = None
+        self._view = None
+        # данные изменены после mmap, нужен remap перед чтением
+        self._mapping_stale = False
+        self._directory_dirty = False
+        self._end_sector = 0
+
+    @property
+    def writable(self) -> bool:
+        return self.mode != 'r'
+
+    def open(self):
+        if self.mode == 'w':
+            self.file_stream = open(self.file_path, 'w+b')
+            self.file_stream.write(IMG_HEADER.pack(IMG_VERSION_2, 0).ljust(SECTOR_SIZE, b'\x00'))
+            self.file_stream.flush()
+            self.version = IMG_VERSION_2
+            self._map()
+            self._build_index()
+        else:
+            if os.path.splitext(self.file_path)[1].lower() == '.dir':
+                self.dir_path = self.file_path
+                self.file_path = find_sibling(self.dir_path, '.img')
+                if self.file_path is None:
+                    raise FileNotFoundError(f'No .img file for {self.dir_path}')
+            self.file_stream = open(self.file_path, 'rb' if self.mode == 'r' else 'r+b')
+            self._map()
+            self._read_directory()
+
+        self._end_sector = max(
+            [sectors_for(len(self._view))] + [entry.offset + sectors_for(entry.size) for entry in self.entries]
+        )
+        return self
+
+    def close(self):
+        if self.file_stream is not None and self.writable:
+            self.flush()
+        self._unmap()
+        if self.file_stream is not None:
+            self.file_stream.close()
+            self.file_stream = None
+
+    @property
+    def source_paths(self) -> list:
+        return [self.file_path] if self.dir_path is None else [self.dir_path, self.file_path]
+
+    def _map(self):
+        self._unmap()
+        if os.fstat(self.file_stream.fileno()).st_size == 0:
+            # пустой .img у v1 архива без записей, mmap такой файл не откроет
+            self._view = memoryview(b'')
+        else:
+            self._mmap = mmap.mmap(self.file_stream.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        self._mapping_stale = False
+
+    def _unmap(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _ensure_mapped(self):
+        if self._mapping_stale:
+            self.file_stream.flush()
+            self._map()
+
+    def _read_directory(self):
+        version = bytes(self._view[:4])
+        if version != IMG_VERSION_2:
+            if self.dir_path is None:
+                self.dir_path = find_sibling(self.file_path, '.dir')
+            if self.dir_path is None:
+                raise ValueError(f'Unsupported IMG version {version!r} in {self.file_path}')
+            self._read_v1_directory()
+            return
+
+        version, files_count = IMG_HEADER.unpack_from(self._view, 0)
+
+        self.version = version
+        directory_end = IMG_HEADER.size + files_count * IMG_DIRECTORY_ENTRY.size
+        directory = self._view[IMG_HEADER.size:directory_end]
+
+        self.entries = [
+            ImgEntry(offset, streaming_size, archive_size, decode_entry_name(name))
+            for offset, streaming_size, archive_size, name in IMG_DIRECTORY_ENTRY.iter_unpack(directory)
+        ]
+        directory.release()
+
+        self._build_index()
+
+    def _read_v1_directory(self):
+        with open(self.dir_path, 'rb') as f:
+            directory = f.read()
+        # лишние байты в конце .dir игнорируются
+        directory = memoryview(directory)[:len(directory) - len(directory) % IMG_V1_DIRECTORY_ENTRY.size]
+
+        self.version = IMG_VERSION_1
+        self.entries = [
+            ImgEntry(offset, size, 0, decode_entry_name(name))
+            for offset, size, name in IMG_V1_DIRECTORY_ENTRY.iter_unpack(directory)
+        ]
+        self._build_index()
+
+    def _build_index(self):
+        self.entries_by_name = {}
+        self.entries_by_extension = {}
+        for entry in self.entries:
+            key = normalize_name(entry.name)
+            # при повторяющихся именах игра берет последнюю запись
+            self.entries_by_name[key] = entry
+            extension = os.path.splitext(key)[1]
+            self.entries_by_extension.setdefault(extension, []).append(entry)
+
+    def get_entry(self, name: str) -> ImgEntry:
+        return self.entries_by_name[normalize_name(name)]
+
+    def find_entry(self, name: str) -> ImgEntry | None:
+        return self.entries_by_name.get(normalize_name(name))
+
+    def get_entries_by_extension(self, extension: str) -> list[ImgEntry]:
+        return self.entries_by_extension.get(normalize_extension(extension), [])
+
+    def find_entries(self, patterns=None, extensions=None) -> list[ImgEntry]:
+        # одна запись на имя, как в entries_by_name
+        entries = list(self.entries_by_name.values())
+        if patterns:
+            patterns = [normalize_name(pattern) for pattern in patterns]
+            entries = [
+                entry for entry in entries
+                if any(fnmatch.fnmatchcase(normalize_name(entry.name), pattern) for pattern in patterns)
+            ]
+        if extensions:
+            extensions = {normalize_extension(extension) for extension in extensions}
+            entries = [
+                entry for entry in entries
+                if os.path.splitext(normalize_name(entry.name))[1] in extensions
+            ]
+        return entries
+
+    def extract(self, output_dir, patterns=None, extensions=None, workers=None, on_extracted=None, entries=None) -> list[ImgEntry]:
+        if entries is None:
+            entries = self.find_entries(patterns, extensions)
+        os.makedirs(output_dir, exist_ok=True)
+
+        def extract_entry(entry):
+            self.extract_entry(entry, os.path.join(output_dir, os.path.basename(entry.name)))
+            if on_extracted is not None:
+                on_extracted(entry)
+            return entry
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() чтобы ошибки воркеров не терялись
+            return list(executor.map(extract_entry, entries))
+
+    def extract_entry(self, entry: ImgEntry | str, output_path):
+        if isinstance(entry, str):
+            entry = self.get_entry(entry)
+        self._ensure_mapped()
+        with open(output_path, 'wb') as output:
+            copy_range(self.file_stream.fileno(), output.fileno(), entry.byte_offset, entry.size, self._view)
+
+    def get_data(self, entry: ImgEntry | str) -> memoryview:
+        if isinstance(entry, str):
+            entry = self.get_entry(entry)
+        self._ensure_mapped()
+        start = entry.byte_offset
+        return self._view[start:start + entry.size]
+
+    # - Запись --------------------------------------------------------
+
+    def _check_writable(self):
+        if not self.writable:
+            raise ValueError(f'IMG archive {self.file_path} is opened read-only')
+
+    def _write_sectors(self, sector, data):
+        size = len(data)
+        self.file_stream.seek(sector * SECTOR_SIZE)
+        self.file_stream.write(data)
+        padding = sectors_for(size) * SECTOR_SIZE - size
+        if padding:
+            self.file_stream.write(bytes(padding))
+        self._end_sector = max(self._end_sector, sector + sectors_for(size))
+        self._mapping_stale = True
+
+    def _read_sectors(self, entry: ImgEntry) -> bytes:
+        self.file_stream.seek(entry.byte_offset)
+        return self.file_stream.read(entry.size)
+
+    def add(self, name: str, data) -> ImgEntry:
+        self._check_writable()
+        encode_entry_name(name)
+        data = memoryview(data).cast('B')
+        size = sectors_for(len(data))
+
+        entry = self.find_entry(name)
+        if entry is not None and size <= entry.streaming_size:
+            # помещается на старое место
+            self._write_sectors(entry.offset, data)
+        else:
+            offset = self._end_sector
+            self._write_sectors(offset, data)
+            if entry is None:
+                entry = ImgEntry(offset, size, 0, name)
+                self.entries.append(entry)
+                self._index_entry(entry)
+            entry.offset = offset
+
+        entry.streaming_size = size
+        entry.archive_size = 0
+        self._directory_dirty = True
+        return entry
+
+    def remove(self, name: str):
+        self._check_writable()
+        entry = self.get_entry(name)
+        key = normalize_name(name)
+        self.entries = [item for item in self.entries if normalize_name(item.name) != key]
+        self._build_index()
+        self._directory_dirty = True
+        return entry
+
+    def _index_entry(self, entry: ImgEntry):
+        key = normalize_name(entry.name)
+        self.entries_by_name[key] = entry
+        extension = os.path.splitext(key)[1]
+        self.entries_by_extension.setdefault(extension, []).append(entry)
+
+    def _directory_sectors(self, count) -> int:
+        if self.version == IMG_VERSION_1:
+            return 0
+        return sectors_for(IMG_HEADER.size + count * IMG_DIRECTORY_ENTRY.size)
+
+    def _pack_directory(self) -> bytes:
+        if self.version == IMG_VERSION_1:
+            return b''.join(
+                IMG_V1_DIRECTORY_ENTRY.pack(entry.offset, entry.streaming_size, encode_entry_name(entry.name))
+                for entry in self.entries
+            )
+        return IMG_HEADER.pack(IMG_VERSION_2, len(self.entries)) + b''.join(
+            IMG_DIRECTORY_ENTRY.pack(entry.offset, entry.streaming_size, entry.archive_size, encode_entry_name(entry.name))
+            for entry in self.entries
+        )
+
+    def flush(self):
+        self._check_writable()
+        if not self._directory_dirty:
+            self.file_stream.flush()
+            return
+
+        directory_sectors = self._directory_sectors(len(self.entries))
+        if any(entry.offset < directory_sectors and entry.streaming_size for entry in self.entries):
+            # каталог не помещается перед данными: переносим мешающие записи в конец
+            directory_sectors = self._directory_sectors(len(self.entries) + DIRECTORY_GROWTH)
+            self._end_sector = max(self._end_sector, directory_sectors)
+            for entry in self.entries:
+                if entry.offset < directory_sectors and entry.streaming_size:
+                    data = self._read_sectors(entry)
+                    entry.offset = self._end_sector
+                    self._write_sectors(entry.offset, data)
+
+        self._write_directory(self.file_stream)
+        self.file_stream.flush()
+        self._end_sector = max(self._end_sector, directory_sectors)
+        self._mapping_stale = True
+        self._directory_dirty = False
+
+    def _write_directory(self, file_stream):
+        if self.version == IMG_VERSION_1:
+            with open(self.dir_path, 'wb') as f:
+                f.write(self._pack_directory())
+            return
+        file_stream.seek(0)
+        file_stream.write(self._pack_directory())
+
+    def compact(self) -> int:
+        # Переписывает архив без мертвых секторов, возвращает число освобожденных секторов
+        self._check_writable()
+        self.flush()
+
+        old_sectors = self._end_sector
+        tmp_path = f'{self.file_path}.compact'
+        entries = sorted(self.entries, key=lambda entry: entry.offset)
+        sector = self._directory_sectors(len(self.entries))
+
+        self._ensure_mapped()
+        with open(tmp_path, 'w+b') as output:
+            new_offsets = {}
+            for entry in entries:
+                output.seek(sector * SECTOR_SIZE)
+                copy_range(self.file_stream.fileno(), output.fileno(), entry.byte_offset, entry.size, self._view)
+                new_offsets[id(entry)] = sector
+                sector += sectors_for(entry.size)
+            output.truncate(sector * SECTOR_SIZE)
+
+            for entry in entries:
+                entry.offset = new_offsets[id(entry)]
+            if self.version != IMG_VERSION_1:
+                self._write_directory(output)
+
+        self._unmap()
+        self.file_stream.close()
+        os.replace(tmp_path, self.file_path)
+        if self.version == IMG_VERSION_1:
+            # .dir пишется только после замены .img
+            self._write_directory(None)
+        self.file_stream = open(self.file_path, 'r+b')
+        self._map()
+        self._end_sector = sector
+        return old_sectors - sector
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, name):
+        return normalize_name(name) in self.entries_by_name
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# архивы, открытые в этом процессе, для воркеров пулов процессов
+_shared_archives: dict[str, ImgArchive] = {}
+
+
+def get_shared_archive(path) -> ImgArchive:
+    # Архив открывается один раз на процесс и остается открытым до его завершения
+    archive = _shared_archives.get(path)
+    if archive is None:
+        archive = _shared_archives[path] = ImgArchive(path).open()
+    return archive
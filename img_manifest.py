@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from img_archive import ImgArchive, ImgEntry, normalize_name
+
+
+MANIFEST_VERSION = 1
+MANIFEST_FILE_NAME = '.img_manifest.json'
+
+
+def hash_data(data) -> str:
+    # hashlib отпускает GIL на больших буферах, поэтому хэши считаются в потоках
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class ImgManifest:
+    """
+    Persisted state of the previous run over an IMG archive: archive mtime
+    and size plus (offset, streaming_size, hash) of every processed entry.
+
+    When the archive mtime and size are unchanged nothing is hashed at all,
+    otherwise entries are hashed from the mmap and compared one by one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.archive_mtime = None
+        self.archive_size = None
+        self.entries: dict[str, list] = {}
+        self._pending: dict[str, list] = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError):
+            return self
+        if data.get('version') != MANIFEST_VERSION:
+            return self
+
+        self.archive_mtime = data['archive_mtime']
+        self.archive_size = data['archive_size']
+        self.entries = data['entries']
+        return self
+
+    def save(self):
+        data = {
+            'version': MANIFEST_VERSION,
+            'archive_mtime': self.archive_mtime,
+            'archive_size': self.archive_size,
+            'entries': self.entries
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(data))
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _stat(archive: ImgArchive):
+        # у v1 архива учитывается и .dir
+        stats = [os.stat(path) for path in archive.source_paths]
+        return max(stat.st_mtime_ns for stat in stats), sum(stat.st_size for stat in stats)
+
+    def is_archive_unchanged(self, archive: ImgArchive) -> bool:
+        return self._stat(archive) == (self.archive_mtime, self.archive_size)
+
+    def get_changed_entries(self, archive: ImgArchive, entries: list[ImgEntry] | None = None, workers=None) -> list[ImgEntry]:
+        if entries is None:
+            entries = archive.find_entries()
+
+        if self.is_archive_unchanged(archive):
+            to_check = [entry for entry in entries if normalize_name(entry.name) not in self.entries]
+        else:
+            to_check = entries
+
+        def make_record(entry):
+            with archive.get_data(entry) as data:
+                return [entry.offset, entry.streaming_size, hash_data(data)]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            records = list(executor.map(make_record, to_check))
+
+        self._pending = {}
+        changed = []
+        for entry, record in zip(to_check, records):
+            name = normalize_name(entry.name)
+            self._pending[name] = record
+            if self.entries.get(name) != record:
+                changed.append(entry)
+        return changed
+
+    def update(self, archive: ImgArchive, names=None):
+        # Вызывать после успешной обработки записей из get_changed_entries.
+        # names: только эти измененные записи считаются обработанными, остальные
+        # измененные выпадают из манифеста и будут обработаны в следующий раз
+        pending = self._pending
+        if names is not None:
+            done = {normalize_name(name) for name in names}
+            pending = {
+                name: record for name, record in pending.items()
+                if name in done or self.entries.get(name) == record
+            }
+        if not self.is_archive_unchanged(archive):
+            # непроверенные в этом запуске записи могли измениться
+            self.entries = {}
+        # необработанные измененные записи удаляются, их старые данные уже не верны
+        for name in self._pending.keys() - pending.keys():
+            self.entries.pop(name, None)
+        self.entries.update(pending)
+        self._pending = {}
+        self.entries = {name: record for name, record in self.entries.items() if name in archive}
+        self.archive_mtime, self.archive_size = self._stat(archive)
+
+
+def extract_incremental(archive: ImgArchive, output_dir, patterns=None, extensions=None, workers=None,
+                        on_extracted=None, manifest_path=None) -> list[ImgEntry]:
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = ImgManifest(manifest_path or os.path.join(output_dir, MANIFEST_FILE_NAME)).load()
+
+    entries = archive.find_entries(patterns, extensions)
+    changed = manifest.get_changed_entries(archive, entries, workers)
+
+    # файлы, удаленные из output_dir, тоже извлекаются заново
+    changed_names = {normalize_name(entry.name) for entry in changed}
+    changed += [
+        entry for entry in entries
+        if normalize_name(entry.name) not in changed_names
+        and not os.path.exists(os.path.join(output_dir, os.path.basename(entry.name)))
+    ]
+
+    extracted = archive.extract(output_dir, workers=workers, on_extracted=on_extracted, entries=changed)
+    manifest.update(archive)
+    manifest.save()
+    return extracted
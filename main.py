@@ -1,23 +1,39 @@
-import struct
-import os
+import argparse
+
+from img_archive import ImgArchive
+from img_manifest import extract_incremental
 
 IMG_ARCHIVE_PATH = r"C:\Games\GTA Criminal Russia\models\gamemod.img"
 
-with open(IMG_ARCHIVE_PATH, 'rb') as f:
-    version, files_count = struct.unpack('4sI',f.read(8))
-    print(version, files_count)
-    files_data = []
-    for i in range(files_count):
-        offset, streaming_size, _, name = struct.unpack('Ihh24s', f.read(32))
-        files_data.append({
-            'offset': offset, 
-            'streaming_size': streaming_size, 
-            'name': name.decode('utf-8').rstrip('\x00')
-        })
-    if not os.path.exists('./files_data'):
-        os.mkdir('./files_data')
-    for i in files_data:
-        f.seek(i['offset'] * 2048)
-        with open(f'./files_data/{i["name"]}', 'wb') as b:
-            b.write(f.read(2048 * i['streaming_size']))
-            print(f'Сохранен файл: {i["name"]}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Извлечение файлов из IMG архива')
+    parser.add_argument('archive', nargs='?', default=IMG_ARCHIVE_PATH)
+    parser.add_argument('-o', '--output', default='./files_data')
+    parser.add_argument('-p', '--pattern', action='append', help='glob по имени файла, например "*.dff"')
+    parser.add_argument('-e', '--extension', action='append', help='расширение, например txd')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='количество потоков')
+    parser.add_argument('-i', '--incremental', action='store_true', help='извлекать только измененные файлы')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args()
+
+    def on_extracted(entry):
+        if not args.quiet:
+            print(f'Сохранен файл: {entry.name}')
+
+    with ImgArchive(args.archive) as archive:
+        print(archive.version, len(archive))
+        extract = extract_incremental if args.incremental else ImgArchive.extract
+        extracted = extract(
+            archive,
+            args.output,
+            patterns=args.pattern,
+            extensions=args.extension,
+            workers=args.jobs,
+            on_extracted=on_extracted
+        )
+        print(f'Извлечено файлов: {len(extracted)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import io
+import mmap
+import os
+import struct
+
+import numpy as np
+
+
+CHUNK_HEADER = struct.Struct('<3I')
+SECTION_STRUCT = 0x1
+
+
+class BufferStream:
+    """
+    Read-only file-like wrapper over any buffer (bytes, mmap, memoryview
+    slice from ImgArchive.get_data) that keeps the underlying memory
+    shared. read() returns bytes like a regular file, read_view() returns
+    a memoryview slice without copying.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self.position = 0
+        self._mmap = None
+
+    @classmethod
+    def from_file(cls, path):
+        # файл отображается в память целиком, читаются только затронутые страницы
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b'')
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        stream = cls(mapping)
+        stream._mmap = mapping
+        return stream
+
+    def read(self, size=-1) -> bytes:
+        return bytes(self.read_view(size))
+
+    def read_view(self, size=-1) -> memoryview:
+        start = self.position
+        if size is None or size < 0:
+            end = len(self.buffer)
+        else:
+            end = min(start + size, len(self.buffer))
+        self.position = max(end, start)
+        return self.buffer[start:end]
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = len(self.buffer) + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+        if self.position < 0:
+            raise ValueError('Negative seek position')
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.buffer.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # на данные еще есть view (например, массивы NumPy), mmap закроется вместе с ними
+                pass
+            self._mmap = None
+
+
+def read_array(stream, dtype, count) -> np.ndarray:
+    # массив NumPy поверх данных потока: у BufferStream без копирования
+    size = np.dtype(dtype).itemsize * count
+    read_view = getattr(stream, 'read_view', None)
+    data = read_view(size) if read_view is not None else stream.read(size)
+    return np.frombuffer(data, dtype, count)
+
+
+def open_stream(source):
+    # Возвращает (BufferStream, нужно ли его закрывать)
+    if isinstance(source, (str, os.PathLike)):
+        return BufferStream.from_file(source), True
+    if isinstance(source, BufferStream):
+        return source, False
+    if hasattr(source, 'read'):
+        # обычный файловый объект читается до конца
+        return BufferStream(source.read()), True
+    return BufferStream(source), True
+
+
+class ChunkWalker:
+    """
+    Iterative walk over the RenderWare chunk tree in a buffer, without
+    recursion: open containers are kept on an explicit stack of
+    (end, type). Iterating yields (type, size, version, payload) for every
+    chunk in file order, payload is a memoryview slice of the buffer.
+
+    Chunks whose type is in containers are entered, everything else is
+    skipped by moving the position to its end. Calling skip() right after
+    a container is yielded skips its whole subtree the same way. A zero
+    chunk type at the top level (sector padding in IMG archives) ends the
+    walk, a header that does not fit into its parent ends the parent.
+    """
+
+    def __init__(self, buffer, containers=frozenset(), start=0, end=None):
+        self.buffer = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+        self.containers = containers
+        self.position = start
+        self.end = len(self.buffer) if end is None else end
+        self.stack: list[tuple[int, int]] = []
+        # смещение заголовка последнего отданного чанка
+        self.offset = start
+        self._skip = False
+
+    @property
+    def depth(self) -> int:
+        return len(self.stack)
+
+    @property
+    def parent(self) -> int | None:
+        # тип контейнера, в котором лежит текущий чанк
+        return self.stack[-1][1] if self.stack else None
+
+    def skip(self):
+        self._skip = True
+
+    def __iter__(self):
+        buffer = self.buffer
+        stack = self.stack
+        containers = self.containers
+        unpack_from = CHUNK_HEADER.unpack_from
+
+        while True:
+            limit = stack[-1][0] if stack else self.end
+            if self.position + CHUNK_HEADER.size > limit:
+                if not stack:
+                    return
+                self.position = stack.pop()[0]
+                continue
+
+            chunk_type, size, version = unpack_from(buffer, self.position)
+            if chunk_type == 0 and not stack:
+                return
+            start = self.position + CHUNK_HEADER.size
+            end = min(start + size, limit)
+
+            self.offset = self.position
+            self._skip = False
+            yield chunk_type, size, version, buffer[start:end]
+
+            if chunk_type in containers and not self._skip:
+                stack.append((end, chunk_type))
+                self.position = start
+            else:
+                self.position = end
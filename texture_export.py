@@ -0,0 +1,327 @@
+import argparse
+import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from pathlib import Path
+
+from dxtdecompress import D3DFORMAT, decode_raster_level, get_level, pick_level
+from texture_store import TEXTURE_STORE_PATH, TextureStore
+
+
+# сколько байт сжатых данных копируется в один блок shared memory
+BATCH_SIZE = 64 * 1024 * 1024
+# сколько заполненных блоков может ждать воркеров, ограничивает память
+MAX_PENDING_BATCHES = 2
+
+DDS_MAGIC = b'DDS '
+DDS_HEADER = struct.Struct('<7I44x2I4s5I5I')
+
+DDSD_CAPS = 0x1
+DDSD_HEIGHT = 0x2
+DDSD_WIDTH = 0x4
+DDSD_PITCH = 0x8
+DDSD_PIXELFORMAT = 0x1000
+DDSD_MIPMAPCOUNT = 0x20000
+DDSD_LINEARSIZE = 0x80000
+
+DDPF_ALPHAPIXELS = 0x1
+DDPF_FOURCC = 0x4
+DDPF_RGB = 0x40
+DDPF_LUMINANCE = 0x20000
+
+DDSCAPS_COMPLEX = 0x8
+DDSCAPS_TEXTURE = 0x1000
+DDSCAPS_MIPMAP = 0x400000
+
+# D3D формат -> (флаги DDPF, бит на пиксель, маски r, g, b, a)
+DDS_UNCOMPRESSED_FORMATS = {
+    D3DFORMAT.D3D_8888: (DDPF_RGB | DDPF_ALPHAPIXELS, 32, 0x00ff0000, 0x0000ff00, 0x000000ff, 0xff000000),
+    D3DFORMAT.D3D_888: (DDPF_RGB, 32, 0x00ff0000, 0x0000ff00, 0x000000ff, 0),
+    D3DFORMAT.D3D_565: (DDPF_RGB, 16, 0xf800, 0x07e0, 0x001f, 0),
+    D3DFORMAT.D3D_555: (DDPF_RGB, 16, 0x7c00, 0x03e0, 0x001f, 0),
+    D3DFORMAT.D3D_1555: (DDPF_RGB | DDPF_ALPHAPIXELS, 16, 0x7c00, 0x03e0, 0x001f, 0x8000),
+    D3DFORMAT.D3D_4444: (DDPF_RGB | DDPF_ALPHAPIXELS, 16, 0x0f00, 0x00f0, 0x000f, 0xf000),
+    D3DFORMAT.D3DFMT_L8: (DDPF_LUMINANCE, 8, 0xff, 0, 0, 0),
+    D3DFORMAT.D3DFMT_A8L8: (DDPF_LUMINANCE | DDPF_ALPHAPIXELS, 16, 0xff, 0, 0, 0xff00),
+}
+
+DDS_COMPRESSED_FORMATS = {
+    D3DFORMAT.D3DFMT_DXT1: 8,
+    D3DFORMAT.D3DFMT_DXT2: 16,
+    D3DFORMAT.D3DFMT_DXT3: 16,
+    D3DFORMAT.D3DFMT_DXT4: 16,
+    D3DFORMAT.D3DFMT_DXT5: 16,
+}
+
+
+def write_dds(path, raster_meta, payload):
+    # Без декодирования: заголовок DDS + данные уровней как есть
+    width, height = raster_meta['width'], raster_meta['height']
+    data = get_level(raster_meta, payload, 0)[0]
+    d3d_format = D3DFORMAT(raster_meta['d3d_format'])
+
+    if d3d_format in DDS_COMPRESSED_FORMATS:
+        size = max(1, (width + 3) // 4) * max(1, (height + 3) // 4) * DDS_COMPRESSED_FORMATS[d3d_format]
+        flags = DDSD_CAPS | DDSD_HEIGHT | DDSD_WIDTH | DDSD_PIXELFORMAT | DDSD_LINEARSIZE
+        pixel_format = (DDPF_FOURCC, d3d_format.value.to_bytes(4, 'little'), 0, 0, 0, 0, 0)
+        pitch_or_size = size
+    elif d3d_format in DDS_UNCOMPRESSED_FORMATS:
+        pf_flags, bit_count, r_mask, g_mask, b_mask, a_mask = DDS_UNCOMPRESSED_FORMATS[d3d_format]
+        pitch_or_size = width * bit_count // 8
+        size = pitch_or_size * height
+        flags = DDSD_CAPS | DDSD_HEIGHT | DDSD_WIDTH | DDSD_PIXELFORMAT | DDSD_PITCH
+        pixel_format = (pf_flags, b'\x00' * 4, bit_count, r_mask, g_mask, b_mask, a_mask)
+    else:
+        raise ValueError(f'Unsupported DDS format {d3d_format.name}')
+
+    if len(data) < size:
+        raise ValueError(f'Raster {raster_meta["name"]} is truncated: {len(data)} < {size}')
+
+    levels = [data[:size]] + [
+        get_level(raster_meta, payload, i)[0] for i in range(1, len(raster_meta.get('levels') or []))
+    ]
+    caps = DDSCAPS_TEXTURE
+    if len(levels) > 1:
+        flags |= DDSD_MIPMAPCOUNT
+        caps |= DDSCAPS_COMPLEX | DDSCAPS_MIPMAP
+
+    header = DDS_HEADER.pack(
+        124, flags, height, width, pitch_or_size, 0, len(levels),
+        32, *pixel_format,
+        caps, 0, 0, 0, 0
+    )
+    with open(path, 'wb') as f:
+        f.write(DDS_MAGIC)
+        f.write(header)
+        for level in levels:
+            f.write(level)
+
+
+# - Воркер ------------------------------------------------------------
+
+_attached_memory = {}
+
+
+def _attach(name):
+    shm = _attached_memory.get(name)
+    if shm is None:
+        # блоки переиспользуются по кругу, старые подключения закрываем
+        while len(_attached_memory) > MAX_PENDING_BATCHES:
+            _attached_memory.pop(next(iter(_attached_memory))).close()
+        shm = _attached_memory[name] = shared_memory.SharedMemory(name=name)
+    return shm
+
+
+def _write_texture(payload, raster_meta, output_path, image_format, max_size):
+    if image_format == 'dds':
+        write_dds(output_path, raster_meta, payload)
+    else:
+        level = 0 if max_size is None else pick_level(raster_meta, max_size)
+        decode_raster_level(raster_meta, payload, level).save(output_path)
+
+
+def _export_texture(shm_name, offset, size, raster_meta, output_path, image_format, max_size):
+    view = _attach(shm_name).buf[offset:offset + size]
+    try:
+        _write_texture(view, raster_meta, output_path, image_format, max_size)
+        error = None
+    except Exception as ex:
+        error = f'{type(ex).__name__}: {ex}'
+    # после except ссылок на view из кадров не остается
+    view.release()
+    return output_path, error
+
+
+# - Родительский процесс ----------------------------------------------
+
+class _Batch:
+    def __init__(self, capacity):
+        self.memory = shared_memory.SharedMemory(create=True, size=max(capacity, 1))
+        self.capacity = capacity
+        self.used = 0
+        self.futures = []
+
+    def add(self, data) -> int:
+        offset = self.used
+        self.memory.buf[offset:offset + len(data)] = data
+        self.used += len(data)
+        return offset
+
+    def release(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+class TextureExporter:
+    """
+    Decodes and saves textures on a process pool. Compressed payloads are
+    copied once into shared memory blocks and workers decode straight from
+    them, only names, offsets and raster metadata are pickled. At most
+    MAX_PENDING_BATCHES + 1 blocks of batch_size bytes exist at a time.
+    """
+
+    def __init__(self, output_dir, image_format='png', workers=None, batch_size=BATCH_SIZE, max_size=None):
+        if image_format not in ('png', 'dds'):
+            raise ValueError(f'Unsupported image format {image_format!r}')
+        self.output_dir = output_dir
+        self.image_format = image_format
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size
+        # для png: декодировать самый крупный мипмап не больше max_size
+        self.max_size = max_size
+        self.executor = None
+
+    def __enter__(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(cancel_futures=exc_type is not None)
+        self.executor = None
+
+    def export(self, textures):
+        """
+        textures: iterable of (txd_name, name, raster_meta, payload), payload
+        as yielded by txt_parser.iter_textures. Textures are saved to
+        output_dir/<TXD>/<name>, the same name is common across TXDs.
+        Yields (output_path, error) as batches complete, error is None on success.
+        """
+        pending = deque()
+        batch = None
+        txd_dirs = set()
+        try:
+            for txd_name, name, raster_meta, data in textures:
+                data = memoryview(data).cast('B')
+                size = len(data)
+                if batch is None or batch.used + size > batch.capacity:
+                    if batch is not None:
+                        pending.append(batch)
+                    while len(pending) >= MAX_PENDING_BATCHES:
+                        yield from self._drain(pending.popleft())
+                    batch = _Batch(max(self.batch_size, size))
+
+                offset = batch.add(data)
+                data.release()
+
+                txd_dir = os.path.join(self.output_dir, Path(txd_name).stem)
+                if txd_dir not in txd_dirs:
+                    os.makedirs(txd_dir, exist_ok=True)
+                    txd_dirs.add(txd_dir)
+                output_path = os.path.join(txd_dir, f'{name}.{self.image_format}')
+                batch.futures.append(self.executor.submit(
+                    _export_texture, batch.memory.name, offset, size,
+                    raster_meta, output_path, self.image_format, self.max_size
+                ))
+
+            if batch is not None:
+                pending.append(batch)
+                batch = None
+            while pending:
+                yield from self._drain(pending.popleft())
+        finally:
+            for item in ([batch] if batch is not None else []) + list(pending):
+                for future in item.futures:
+                    future.cancel()
+                for future in item.futures:
+                    if not future.cancelled():
+                        future.exception()
+                item.release()
+
+    @staticmethod
+    def _drain(batch: _Batch):
+        try:
+            for future in batch.futures:
+                yield future.result()
+        finally:
+            batch.futures = []
+            batch.release()
+
+
+def iter_store_textures(store_path=TEXTURE_STORE_PATH, txd_source='./txd_files'):
+    # Метаданные из хранилища, данные растров - срезы самих TXD по payload_offset/payload_size.
+    # txd_source: папка с TXD или IMG архив, из которого строилось хранилище
+    from txt_parser import TxdReader
+
+    archive = None
+    if os.path.isfile(txd_source):
+        from img_archive import ImgArchive
+
+        archive = ImgArchive(txd_source).open()
+    try:
+        with TextureStore(store_path) as store:
+            for txd_name, info, textures in store.iter_txds():
+                if archive is not None:
+                    if txd_name not in archive:
+                        print(f'File {txd_name} is not found')
+                        continue
+                    source = archive.get_data(txd_name)
+                else:
+                    source = os.path.join(txd_source, txd_name)
+                    if not os.path.exists(source):
+                        print(f'File {txd_name} is not found')
+                        continue
+                try:
+                    with TxdReader(source, Path(txd_name).stem) as f:
+                        for raster_meta in textures:
+                            payload = f.read_payload(raster_meta)
+                            try:
+                                yield txd_name, raster_meta['name'], raster_meta, payload
+                            finally:
+                                payload.release()
+                finally:
+                    if archive is not None:
+                        source.release()
+    finally:
+        if archive is not None:
+            archive.close()
+
+
+def iter_archive_textures(img_path):
+    # TXD читаются прямо из IMG архива, без временных файлов
+    from txt_parser import TxdReader, iter_textures, iter_txd_sources
+
+    for name, source in iter_txd_sources(img_path):
+        with TxdReader(source, Path(name).stem) as f:
+            texture_dictionary = f.read_texture_dictionary()
+            if texture_dictionary is None:
+                print(f'File {name} is have the broken header')
+                continue
+            for raster_meta, payload in iter_textures(f):
+                try:
+                    yield name, raster_meta['name'], raster_meta, payload
+                finally:
+                    # иначе mmap архива нельзя будет закрыть
+                    payload.release()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Пакетный экспорт текстур')
+    parser.add_argument('--img', default=None, help='брать TXD прямо из IMG архива вместо хранилища метаданных')
+    parser.add_argument('--store', default=TEXTURE_STORE_PATH, help='хранилище метаданных, если нет --img')
+    parser.add_argument('--txd-source', default='./txd_files', help='папка или IMG архив с TXD хранилища')
+    parser.add_argument('-o', '--output', default='./decoded_files')
+    parser.add_argument('-f', '--format', choices=('png', 'dds'), default='png')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='количество процессов')
+    parser.add_argument('--max-size', type=int, default=None, help='для png: декодировать мипмап не больше N x N')
+    args = parser.parse_args()
+
+    textures = (
+        iter_store_textures(args.store, args.txd_source) if args.img is None else iter_archive_textures(args.img)
+    )
+
+    exported = errors = 0
+    with TextureExporter(args.output, args.format, args.jobs, max_size=args.max_size) as exporter:
+        for output_path, error in exporter.export(textures):
+            if error is None:
+                exported += 1
+            else:
+                errors += 1
+                print(error, output_path)
+    print(f'Сохранено текстур: {exported}, ошибок: {errors}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import argparse
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from dff_parser import DffParser
+from texture_store import TEXTURE_STORE_PATH, TextureStore, TextureStoreWriter, normalize_txd_name
+from txt_parser import TxdReader, iter_txd_sources
+
+
+# Имена текстур в игре регистронезависимые
+def normalize_texture_name(name: str) -> str:
+    return name.lower()
+
+
+@dataclass
+class TextureLocation:
+    name: str
+    txd: str
+    d3d_format: int
+    raster_format: str
+    width: int
+    height: int
+    payload_offset: int
+    payload_size: int
+
+
+@dataclass
+class ModelTextureReport:
+    # имена текстур, которых нет в индексе (или в TXD модели, если он задан)
+    missing: list[str] = field(default_factory=list)
+    # имя текстуры -> все TXD, в которых она есть
+    duplicates: dict[str, list[str]] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return not self.missing and not self.duplicates
+
+
+class TextureIndex:
+    """
+    Texture name -> TXD lookup over the binary texture store. Records stay
+    in the memory-mapped store, only a table of names to record indices is
+    built, on first lookup. Used to check DFF material texture names
+    without parsing TXDs.
+    """
+
+    def __init__(self, path=TEXTURE_STORE_PATH):
+        self.path = path
+        self.store = TextureStore(path)
+        self._names: dict[str, list[tuple[int, int]]] | None = None
+
+    def load(self):
+        # нет хранилища или оно битое - индекс пустой
+        self.close()
+        if os.path.exists(self.path):
+            try:
+                self.store.open()
+            except ValueError:
+                self.store.close()
+        return self
+
+    def close(self):
+        self.store.close()
+        self._names = None
+
+    def build(self, sources, on_error=None):
+        # sources: пары (имя TXD, путь или буфер), как из iter_txd_sources.
+        # Хранилище пишется заново по каталогам TXD, без чтения данных текстур
+        self.close()
+        with TextureStoreWriter(self.path) as writer:
+            for name, source in sources:
+                try:
+                    with TxdReader(source, Path(name).stem) as f:
+                        directory = f.read_directory()
+                except Exception as ex:
+                    if on_error is not None:
+                        on_error(name, ex)
+                    continue
+                if directory is None:
+                    if on_error is not None:
+                        on_error(name, ValueError('broken TXD header'))
+                    continue
+                writer.add_txd(Path(name).name, *directory)
+        return self.load()
+
+    @property
+    def textures_by_name(self) -> dict[str, list[tuple[int, int]]]:
+        # имя текстуры -> [(номер TXD, номер записи текстуры)], только живые записи хранилища
+        if self._names is None:
+            store = self.store
+            counts = store.txds['count'].astype(np.int64)
+            txd_indices = np.repeat(np.arange(len(counts)), counts)
+            records = (
+                np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                + np.repeat(store.txds['first_texture'].astype(np.int64), counts)
+            )
+            strings = store.strings.tobytes()
+            offsets = store.textures['name'][records].tolist()
+            sizes = store.textures['name_size'][records].tolist()
+
+            self._names = {}
+            for txd, record, offset, size in zip(txd_indices.tolist(), records.tolist(), offsets, sizes):
+                name = strings[offset:offset + size].decode('utf-8', errors='replace')
+                self._names.setdefault(normalize_texture_name(name), []).append((txd, record))
+        return self._names
+
+    def _location(self, txd, record) -> TextureLocation:
+        store = self.store
+        texture = store.textures[record]
+        return TextureLocation(
+            name=store.get_string(texture['name'], texture['name_size']),
+            txd=normalize_txd_name(store.txd_name(txd)),
+            d3d_format=int(texture['d3d_format']),
+            raster_format=hex(texture['raster_format']),
+            width=int(texture['width']),
+            height=int(texture['height']),
+            payload_offset=int(texture['payload_offset']),
+            payload_size=int(texture['payload_size'])
+        )
+
+    def find(self, name: str) -> list[TextureLocation]:
+        return [
+            self._location(txd, record)
+            for txd, record in self.textures_by_name.get(normalize_texture_name(name), [])
+        ]
+
+    def get(self, name: str, txd: str | None = None) -> TextureLocation | None:
+        locations = self.find(name)
+        if txd is not None:
+            locations = [location for location in locations if location.txd == normalize_txd_name(txd)]
+        return locations[-1] if locations else None
+
+    def check_model(self, texture_names, txd: str | None = None) -> ModelTextureReport:
+        # texture_names: имена из DffParser.get_texture_names() (пустые имена пропускаются)
+        report = ModelTextureReport()
+        for name in dict.fromkeys(name for name in texture_names if name):
+            locations = self.find(name)
+            if txd is not None:
+                locations = [location for location in locations if location.txd == normalize_txd_name(txd)]
+            if not locations:
+                report.missing.append(name)
+            elif len(locations) > 1:
+                report.duplicates[name] = [location.txd for location in locations]
+        return report
+
+    def __len__(self):
+        return len(self.textures_by_name)
+
+    def __contains__(self, name):
+        return normalize_texture_name(name) in self.textures_by_name
+
+    def __enter__(self):
+        return self.load()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def check_dff(index: TextureIndex, source, txd: str | None = None) -> ModelTextureReport:
+    with DffParser(source) as f:
+        texture_names = [name for name, mask_name in f.get_texture_names()]
+    return index.check_model(texture_names, txd)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Индекс текстур всех TXD')
+    parser.add_argument('--store', default=TEXTURE_STORE_PATH, help='хранилище метаданных текстур')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = commands.add_parser('build', help='построить хранилище по каталогам TXD')
+    build_parser.add_argument('--img', default=None, help='брать TXD прямо из IMG архива')
+
+    check_parser = commands.add_parser('check', help='проверить текстуры моделей')
+    check_parser.add_argument('dff', nargs='+')
+    check_parser.add_argument('--txd', default=None, help='TXD модели')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        def on_error(name, ex):
+            print(ex, f'File: {name}')
+
+        with TextureIndex(args.store) as index:
+            index.build(iter_txd_sources(args.img), on_error)
+            print(f'TXD: {len(index.store)}, текстур: {len(index)}')
+        return
+
+    failed = 0
+    with TextureIndex(args.store) as index:
+        for path in args.dff:
+            report = check_dff(index, path, args.txd)
+            if report.ok:
+                continue
+            failed += 1
+            for name in report.missing:
+                print(f'{path}: нет текстуры {name}')
+            for name, txds in report.duplicates.items():
+                print(f'{path}: текстура {name} есть в {", ".join(txds)}')
+    print(f'Моделей с ошибками: {failed}')
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+import argparse
+import bisect
+import json
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+
+
+TEXTURE_STORE_PATH = 'texture_data.bin'
+
+TEXTURE_STORE_MAGIC = b'TXDM'
+TEXTURE_STORE_VERSION = 2
+
+# magic, version, число TXD, текстур и уровней, смещения таблиц TXD, уровней и строк, размер строк
+TEXTURE_STORE_HEADER = struct.Struct('<4sI7Q')
+
+# строки хранятся в общей таблице как (смещение, длина)
+TXD_RECORD = np.dtype([
+    ('name', '<u4'), ('name_size', '<u4'),
+    ('texture_count', '<u2'), ('device_id', '<u2'),
+    ('first_texture', '<u4'), ('count', '<u4'),
+])
+
+TEXTURE_RECORD = np.dtype([
+    ('name', '<u4'), ('name_size', '<u4'),
+    ('mask_name', '<u4'), ('mask_name_size', '<u4'),
+    ('platform_id', '<i2'), ('filter_mode', '<i2'),
+    ('u_addressing', 'u1'), ('v_addressing', 'u1'),
+    ('pad_texture_format', '<i2'),
+    ('raster_format', '<u4'), ('d3d_format', '<u4'),
+    ('width', '<i2'), ('height', '<i2'),
+    ('depth', 'u1'), ('num_levels', 'u1'), ('raster_type', 'u1'), ('flags', 'u1'),
+    ('palette_offset', '<u4'), ('palette_size', '<u4'),
+    ('first_level', '<u4'), ('level_count', '<u4'),
+    ('payload_offset', '<u8'), ('payload_size', '<u4'),
+])
+
+LEVEL_RECORD = np.dtype([
+    ('offset', '<u4'), ('size', '<u4'), ('width', '<u2'), ('height', '<u2'),
+])
+
+# по сколько байт копируются старые записи в режиме дописывания
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+# биты поля flags, как в заголовке растра
+TEXTURE_FLAGS = ('alpha', 'cube_texture', 'auto_mip_maps', 'compressed')
+
+
+# Имена TXD регистронезависимые, 'Gamemod.txd', './txd_files/gamemod.txd' и 'gamemod' - один TXD
+def normalize_txd_name(name: str) -> str:
+    return Path(name.replace('\\', '/')).stem.lower()
+
+
+class _TxdNames:
+    # ключи отсортированной таблицы TXD для bisect, строки декодируются по запросу
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store.txds)
+
+    def __getitem__(self, i):
+        return normalize_txd_name(self.store.txd_name(i))
+
+
+class TextureStore:
+    """
+    Read side of the binary texture metadata store written by
+    TextureStoreWriter. The file is memory-mapped and the header gives the
+    position of every table, so opening does not depend on the file size.
+
+    Layout: header, fixed-width texture records, TXD records sorted by
+    name, mip level records, string table. The tables are exposed as NumPy
+    structured arrays, get_textures() builds the raster_data dicts used by
+    txt_parser and dxtdecompress for one TXD.
+    """
+
+    def __init__(self, path=TEXTURE_STORE_PATH):
+        self.path = path
+        self.textures = np.empty(0, TEXTURE_RECORD)
+        self.txds = np.empty(0, TXD_RECORD)
+        self.levels = np.empty(0, LEVEL_RECORD)
+        self.strings = np.empty(0, np.uint8)
+        self._txd_names = _TxdNames(self)
+        self._raw = None
+
+    def open(self):
+        self._raw = np.memmap(self.path, np.uint8, 'r')
+        if len(self._raw) < TEXTURE_STORE_HEADER.size:
+            raise ValueError(f'{self.path} is not a texture store')
+        (magic, version, txd_count, texture_count, level_count,
+         txd_offset, level_offset, string_offset, string_size) = TEXTURE_STORE_HEADER.unpack_from(self._raw)
+        if magic != TEXTURE_STORE_MAGIC or version != TEXTURE_STORE_VERSION:
+            raise ValueError(f'Unsupported texture store {magic!r} v{version} in {self.path}')
+        if string_offset + string_size > len(self._raw):
+            raise ValueError(f'Texture store {self.path} is truncated')
+
+        def table(offset, count, dtype):
+            return self._raw[offset:offset + count * dtype.itemsize].view(dtype)
+
+        self.textures = table(TEXTURE_STORE_HEADER.size, texture_count, TEXTURE_RECORD)
+        self.txds = table(txd_offset, txd_count, TXD_RECORD)
+        self.levels = table(level_offset, level_count, LEVEL_RECORD)
+        self.strings = self._raw[string_offset:string_offset + string_size]
+        return self
+
+    def close(self):
+        # mmap закрывается, когда на массивы не остается ссылок
+        self.__init__(self.path)
+
+    def get_string(self, offset, size) -> str:
+        return self.strings[offset:offset + size].tobytes().decode('utf-8', errors='replace')
+
+    def txd_name(self, i) -> str:
+        record = self.txds[i]
+        return self.get_string(record['name'], record['name_size'])
+
+    def txd_names(self) -> list[str]:
+        return [self.txd_name(i) for i in range(len(self.txds))]
+
+    def find_txd(self, name: str) -> int | None:
+        key = normalize_txd_name(name)
+        i = bisect.bisect_left(self._txd_names, key)
+        if i < len(self.txds) and self._txd_names[i] == key:
+            return i
+        return None
+
+    def get_info(self, name: str) -> dict:
+        record = self.txds[self._get_txd(name)]
+        return {'texture_count': int(record['texture_count']), 'device_id': int(record['device_id'])}
+
+    def get_texture_records(self, name: str) -> np.ndarray:
+        record = self.txds[self._get_txd(name)]
+        return self.textures[record['first_texture']:record['first_texture'] + record['count']]
+
+    def get_textures(self, name: str) -> list[dict]:
+        return [self.texture_dict(record) for record in self.get_texture_records(name)]
+
+    def _get_txd(self, name):
+        i = self.find_txd(name)
+        if i is None:
+            raise KeyError(name)
+        return i
+
+    def texture_dict(self, record) -> dict:
+        # та же структура, что у raster_data из TxdReader
+        levels = self.levels[record['first_level']:record['first_level'] + record['level_count']]
+        flags = int(record['flags'])
+        raster_data = {
+            'platform_id': int(record['platform_id']),
+            'filter_mode': int(record['filter_mode']),
+            'u_addressing': int(record['u_addressing']),
+            'v_addressing': int(record['v_addressing']),
+            'pad_texture_format': int(record['pad_texture_format']),
+            'name': self.get_string(record['name'], record['name_size']),
+            'mask_name': self.get_string(record['mask_name'], record['mask_name_size']),
+            'raster_format': hex(record['raster_format']),
+            'd3d_format': int(record['d3d_format']),
+            'width': int(record['width']),
+            'height': int(record['height']),
+            'depth': int(record['depth']),
+            'num_levels': int(record['num_levels']),
+            'raster_type': int(record['raster_type']),
+        }
+        for bit, key in enumerate(TEXTURE_FLAGS):
+            raster_data[key] = flags >> bit & 1
+        raster_data.update({
+            'palette_offset': int(record['palette_offset']),
+            'palette_size': int(record['palette_size']),
+            'levels': [
+                {'offset': int(level['offset']), 'size': int(level['size']),
+                 'width': int(level['width']), 'height': int(level['height'])}
+                for level in levels
+            ],
+            'payload_offset': int(record['payload_offset']),
+            'payload_size': int(record['payload_size'])
+        })
+        return raster_data
+
+    def iter_txds(self):
+        # (имя TXD, info, [raster_data]) в порядке имен
+        for i in range(len(self.txds)):
+            name = self.txd_name(i)
+            yield name, self.get_info(name), self.get_textures(name)
+
+    def __len__(self):
+        return len(self.txds)
+
+    def __contains__(self, name):
+        return self.find_txd(name) is not None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TextureStoreWriter:
+    """
+    Writes texture records to the store as TXDs are parsed, so the whole
+    game never has to be kept in memory. TXD, level and string tables go
+    after the records and the header is written last, on close().
+
+    append=True keeps the records of an existing store: its tail tables
+    are loaded, the old records are copied to a temporary file, new ones
+    are appended after them and the file replaces the store on close().
+    Records of replaced or removed TXDs stay in the file until they
+    outweigh the live ones, then the store is rewritten.
+    """
+
+    def __init__(self, path=TEXTURE_STORE_PATH, append=False):
+        self.path = path
+        self.file_stream = None
+        # normalized name -> [имя, texture_count, device_id, first_texture, count]
+        self.txds: dict[str, list] = {}
+        self.levels = []
+        self.strings = bytearray()
+        self._string_offsets: dict[str, tuple[int, int]] = {}
+        self._texture_count = 0
+        self._dead_textures = 0
+        # записи старого хранилища сохранены; False, если его нет, оно битое
+        # или старой версии и пишется с нуля
+        self.appended = False
+
+        if append and os.path.exists(path):
+            self._open_existing()
+        else:
+            self.file_stream = open(path + '.tmp', 'w+b')
+            self.file_stream.write(bytes(TEXTURE_STORE_HEADER.size))
+
+    def _open_existing(self):
+        try:
+            store = TextureStore(self.path).open()
+        except ValueError:
+            # битый или старый файл пишется заново
+            self.file_stream = open(self.path + '.tmp', 'w+b')
+            self.file_stream.write(bytes(TEXTURE_STORE_HEADER.size))
+            return
+
+        self.strings = bytearray(store.strings.tobytes())
+        self.levels = [store.levels.copy()]
+        for i, record in enumerate(store.txds):
+            name = store.txd_name(i)
+            # имена TXD уже лежат в таблице строк
+            self._string_offsets[name] = (int(record['name']), int(record['name_size']))
+            self.txds[normalize_txd_name(name)] = [
+                name, int(record['texture_count']), int(record['device_id']),
+                int(record['first_texture']), int(record['count'])
+            ]
+        self._texture_count = len(store.textures)
+        self._dead_textures = self._texture_count - sum(txd[4] for txd in self.txds.values())
+        store.close()
+        self.appended = True
+
+        # Старые записи копируются во временный файл, хранилище заменяется только на close():
+        # при ошибке до этого старый файл остается целым
+        records_end = TEXTURE_STORE_HEADER.size + self._texture_count * TEXTURE_RECORD.itemsize
+        self.file_stream = open(self.path + '.tmp', 'w+b')
+        with open(self.path, 'rb') as source:
+            self.file_stream.write(bytes(TEXTURE_STORE_HEADER.size))
+            source.seek(TEXTURE_STORE_HEADER.size)
+            remaining = records_end - TEXTURE_STORE_HEADER.size
+            while remaining > 0:
+                data = source.read(min(remaining, COPY_CHUNK_SIZE))
+                if not data:
+                    break
+                self.file_stream.write(data)
+                remaining -= len(data)
+
+    def _add_string(self, value: str) -> tuple[int, int]:
+        reference = self._string_offsets.get(value)
+        if reference is None:
+            data = value.encode('utf-8')
+            reference = self._string_offsets[value] = (len(self.strings), len(data))
+            self.strings += data
+        return reference
+
+    def _level_count(self) -> int:
+        return sum(len(levels) for levels in self.levels)
+
+    def add_txd(self, name: str, info: dict, textures: list[dict]):
+        # textures: raster_data из TxdReader, TXD с тем же именем заменяется
+        records = np.zeros(len(textures), TEXTURE_RECORD)
+        level_count = self._level_count()
+        levels = []
+        for record, raster_data in zip(records, textures):
+            record['name'], record['name_size'] = self._add_string(raster_data['name'])
+            record['mask_name'], record['mask_name_size'] = self._add_string(raster_data['mask_name'])
+            for key in ('platform_id', 'filter_mode', 'u_addressing', 'v_addressing', 'pad_texture_format',
+                        'd3d_format', 'width', 'height', 'depth', 'num_levels', 'raster_type'):
+                record[key] = raster_data[key]
+            record['raster_format'] = int(raster_data['raster_format'], 16)
+            record['flags'] = sum(1 << bit for bit, key in enumerate(TEXTURE_FLAGS) if raster_data.get(key))
+            record['palette_offset'] = raster_data.get('palette_offset', 0)
+            record['palette_size'] = raster_data.get('palette_size', 0)
+            record['payload_offset'] = raster_data.get('payload_offset', 0)
+            record['payload_size'] = raster_data.get('payload_size', 0)
+
+            mips = raster_data.get('levels') or []
+            record['first_level'] = level_count + len(levels)
+            record['level_count'] = len(mips)
+            levels += [(mip['offset'], mip['size'], mip['width'], mip['height']) for mip in mips]
+
+        self.remove_txd(name)
+        self.file_stream.write(records.tobytes())
+        self.levels.append(np.array(levels, LEVEL_RECORD))
+        self.txds[normalize_txd_name(name)] = [
+            name, info.get('texture_count', len(textures)), info.get('device_id', 0),
+            self._texture_count, len(textures)
+        ]
+        self._texture_count += len(textures)
+
+    def remove_txd(self, name: str):
+        txd = self.txds.pop(normalize_txd_name(name), None)
+        if txd is not None:
+            self._dead_textures += txd[4]
+
+    def txd_names(self) -> list[str]:
+        return [txd[0] for txd in self.txds.values()]
+
+    def close(self):
+        txds = np.zeros(len(self.txds), TXD_RECORD)
+        for record, key in zip(txds, sorted(self.txds)):
+            name, record['texture_count'], record['device_id'], record['first_texture'], record['count'] = self.txds[key]
+            record['name'], record['name_size'] = self._add_string(name)
+        levels = np.concatenate(self.levels) if self.levels else np.empty(0, LEVEL_RECORD)
+
+        txd_offset = self.file_stream.tell()
+        self.file_stream.write(txds.tobytes())
+        level_offset = self.file_stream.tell()
+        self.file_stream.write(levels.tobytes())
+        string_offset = self.file_stream.tell()
+        self.file_stream.write(self.strings)
+
+        self.file_stream.seek(0)
+        self.file_stream.write(TEXTURE_STORE_HEADER.pack(
+            TEXTURE_STORE_MAGIC, TEXTURE_STORE_VERSION, len(txds), self._texture_count, len(levels),
+            txd_offset, level_offset, string_offset, len(self.strings)
+        ))
+        self.file_stream.close()
+        if self.file_stream.name != self.path:
+            os.replace(self.file_stream.name, self.path)
+
+        if self._dead_textures > self._texture_count - self._dead_textures:
+            compact(self.path)
+
+    def abort(self):
+        # временный файл удаляется, старое хранилище остается как было
+        self.file_stream.close()
+        if self.file_stream.name != self.path:
+            os.remove(self.file_stream.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def compact(path=TEXTURE_STORE_PATH):
+    # переписывает хранилище без записей замененных и удаленных TXD
+    tmp_path = path + '.compact'
+    with TextureStore(path) as store, TextureStoreWriter(tmp_path) as writer:
+        for name, info, textures in store.iter_txds():
+            writer.add_txd(name, info, textures)
+    os.replace(tmp_path, path)
+
+
+def import_json(json_path, path=TEXTURE_STORE_PATH):
+    # перенос старого json_data.json
+    with open(json_path, 'r', encoding='utf-8') as f:
+        txd_files = json.loads(f.read())
+    with TextureStoreWriter(path) as writer:
+        for name, txd in txd_files.items():
+            # ключи json - пути вида './txd_files\\a.txd', в хранилище только имя файла
+            writer.add_txd(Path(name.replace('\\', '/')).name, txd['info'], txd['textures'])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Хранилище метаданных текстур')
+    parser.add_argument('--store', default=TEXTURE_STORE_PATH)
+    parser.add_argument('--from-json', default=None, help='создать хранилище из json_data.json')
+    parser.add_argument('txd', nargs='*', help='вывести текстуры этих TXD')
+    args = parser.parse_args()
+
+    if args.from_json is not None:
+        import_json(args.from_json, args.store)
+
+    with TextureStore(args.store) as store:
+        print(f'TXD: {len(store)}, текстур: {len(store.textures)}')
+        for name in args.txd:
+            for raster_data in store.get_textures(name):
+                print(raster_data)
+
+
+if __name__ == '__main__':
+    main()
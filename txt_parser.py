@@ -1,10 +1,28 @@
 import struct
 import glob
+import argparse
 from traceback import format_exc
 from pathlib import Path
-import json
 from enum import Enum
+from dataclasses import dataclass, asdict
 
+from rw_stream import CHUNK_HEADER, SECTION_STRUCT, ChunkWalker, open_stream
+from texture_store import TEXTURE_STORE_PATH, TextureStoreWriter
+
+
+
+SECTION_TEXTURE_NATIVE = 0x15
+SECTION_TEXTURE_DICTIONARY = 0x16
+TXD_CONTAINERS = frozenset({SECTION_TEXTURE_DICTIONARY, SECTION_TEXTURE_NATIVE})
+
+TEXTURE_DICTIONARY_DATA = struct.Struct('<HH')
+# заголовок D3D8/D3D9 растра до палитры и уровней, 88 байт
+RASTER_HEADER = struct.Struct('<hh2BH32s32sIIhh4B')
+
+RASTER_FLAG_ALPHA = 0x1
+RASTER_FLAG_CUBE_TEXTURE = 0x2
+RASTER_FLAG_AUTO_MIP_MAPS = 0x4
+RASTER_FLAG_COMPRESSED = 0x8
 
 
 def unpack_version(libid):
@@ -18,6 +36,8 @@ def make_fourcc(ch1, ch2, ch3, ch4):
 
 
 class D3DFORMAT(Enum):
+    D3DFMT_UNKNOWN = 0
+
     D3D_8888 = 21
     D3D_888  = 22
     D3D_565  = 23
@@ -25,6 +45,7 @@ class D3DFORMAT(Enum):
     D3D_1555 = 25
     D3D_4444 = 26
 
+    D3DFMT_P8   = 41
     D3DFMT_L8   = 50
     D3DFMT_A8L8 = 51
 
@@ -73,166 +94,296 @@ class RasterFormat(Enum):
 
 
 
-class TxdReader:
-    def __init__(self, file_path):
-        self.file_path = file_path
+@dataclass
+class MipLevel:
+    # offset считается от начала данных растра (сразу после заголовка)
+    offset: int
+    size: int
+    width: int
+    height: int
+
+
+# байт на блок 4x4 у сжатых форматов
+COMPRESSED_BLOCK_SIZES = {
+    D3DFORMAT.D3DFMT_DXT1.value: 8,
+    D3DFORMAT.D3DFMT_DXT2.value: 16,
+    D3DFORMAT.D3DFMT_DXT3.value: 16,
+    D3DFORMAT.D3DFMT_DXT4.value: 16,
+    D3DFORMAT.D3DFMT_DXT5.value: 16,
+}
+
+
+def level_size(raster_data, width, height) -> int:
+    block_size = COMPRESSED_BLOCK_SIZES.get(raster_data['d3d_format'])
+    if block_size is not None:
+        return max(1, (width + 3) // 4) * max(1, (height + 3) // 4) * block_size
+    return (width * height * raster_data['depth'] + 7) // 8
+
+
+def compute_raster_levels(raster_data, payload_size):
+    # То же, что read_raster_levels, но размеры уровней считаются
+    # по формату и размеру, без чтения файла
+    palette = palette_size(int(raster_data['raster_format'], 16))
+    levels = []
+    offset = palette
+    width, height = raster_data['width'], raster_data['height']
+    for i in range(raster_data['num_levels']):
+        level_width, level_height = max(1, width >> i), max(1, height >> i)
+        size = level_size(raster_data, level_width, level_height)
+        if offset + 4 + size > payload_size:
+            break
+        levels.append(MipLevel(offset + 4, size, level_width, level_height))
+        offset += 4 + size
+
+    return {
+        'palette_offset': 0,
+        'palette_size': palette,
+        'levels': [asdict(level) for level in levels]
+    }
+
+
+def palette_size(raster_format: int) -> int:
+    if raster_format & RasterFormat.FORMAT_EXT_PAL8.value:
+        return 256 * 4
+    if raster_format & RasterFormat.FORMAT_EXT_PAL4.value:
+        # D3D хранит для PAL4 палитру на 32 цвета
+        return 32 * 4
+    return 0
 
-    def get_section(self):
-        data = self.file_stream.read(12)
-        try:
-            type_section, size, library_id = struct.unpack('<III', data)
-        except:
 
-            if self.file_stream.read(1) == b'':
+class TxdReader:
+    # source: путь, файловый объект или буфер (bytes, memoryview из ImgArchive)
+    def __init__(self, source, name=None):
+        self.source = source
+        self.file_path = source if isinstance(source, (str, Path)) else None
+        self.name = name if name is not None else Path(self.file_path).stem if self.file_path else ''
+        self.texture_dictionary = None
+        # границы TXD секции, в которых лежат Texture Native
+        self._textures_start = 0
+        self._textures_end = 0
+        self._owns_stream = False
+
+    def read_texture_dictionary(self):
+        # Texture Dictionary и его Struct, None если файл начинается не с TXD
+        walker = ChunkWalker(self.file_stream.buffer, TXD_CONTAINERS, self.file_stream.tell())
+        for chunk_type, size, version, payload in walker:
+            if walker.depth == 0:
+                if chunk_type != SECTION_TEXTURE_DICTIONARY:
+                    return None
+                continue
+            if chunk_type != SECTION_STRUCT or len(payload) < TEXTURE_DICTIONARY_DATA.size:
                 return None
 
-        return {
-            'type': hex(type_section),
-            'size': size,
-            'library_id': hex(
-                unpack_version(library_id)
-            )
-        }
-
-    def get_header(self):
-        data = self.file_stream.read(12)
-        try:
-            type_section, size, library_id = struct.unpack('<III', data)
-        except:
+            texture_count, device_id = TEXTURE_DICTIONARY_DATA.unpack_from(payload)
+            self.texture_dictionary = {
+                'texture_count': texture_count,
+                'device_id': device_id
+            }
+            self._textures_start = walker.offset + CHUNK_HEADER.size + size
+            self._textures_end = walker.stack[-1][0]
+            return self.texture_dictionary
+        return None
+
+    def iter_rasters(self):
+        # (payload_offset, заголовок растра, данные после заголовка) для каждого Texture Native
+        walker = ChunkWalker(self.file_stream.buffer, TXD_CONTAINERS, self._textures_start, self._textures_end)
+        for chunk_type, size, version, payload in walker:
+            if chunk_type == SECTION_STRUCT and walker.parent == SECTION_TEXTURE_NATIVE:
+                if len(payload) < RASTER_HEADER.size:
+                    continue
+                yield (
+                    walker.offset + CHUNK_HEADER.size + RASTER_HEADER.size,
+                    parse_raster_header(payload, self.name),
+                    payload[RASTER_HEADER.size:]
+                )
+
+    def read_directory(self):
+        # Метаданные всех текстур и смещения их данных, сами данные не читаются:
+        # размеры уровней считаются по формату. Возвращает (texture_dictionary, [raster_data]) или None.
+        texture_dictionary = self.read_texture_dictionary()
+        if texture_dictionary is None:
             return None
 
-        return {
-            'type': hex(type_section),
-            'size': size,
-            'library_id': hex(
-                unpack_version(library_id)
-            )
-        }
-    
-    def get_texture_dictionary_data(self):
-        textureCount, deviceId = struct.unpack('HH', self.file_stream.read(4))
+        textures = []
+        for payload_offset, raster_data, payload in self.iter_rasters():
+            raster_data['payload_offset'] = payload_offset
+            raster_data['payload_size'] = len(payload)
+            raster_data.update(compute_raster_levels(raster_data, len(payload)))
+            textures.append(raster_data)
+            payload.release()
 
-        return {
-            'texture_count': textureCount,
-            'device_id': deviceId
-        }
-    
-    def get_raster_data(self):
-        # - Texture Format ----------------------------------------------
-        platform_id, filter_mode  = struct.unpack('<hh', self.file_stream.read(4))
-        UAddressing,VAddressing = struct.unpack('2B', self.file_stream.read(2)) 
-
-        pad_texture_format = struct.unpack('h', self.file_stream.read(2))
-        # name
-        try:
-            name = struct.unpack('32s', self.file_stream.read(32))[0].decode('utf-8')
-        except:
-            name = Path(self.file_path).stem
-        
-        # mask name
-        mask_name = struct.unpack('32s', self.file_stream.read(32))[0]
-        # ---------------------------------------------------------------
-
-
-        # - Raster Format -----------------------------------------------
-        raster_format = hex( 
-            struct.unpack('I', self.file_stream.read(4))[0]
-        )
-
-        # формат d3d 
-        bebra = struct.unpack('I', self.file_stream.read(4))[0]
-        try:
-            d3dformat = D3DFORMAT(bebra)
-        except:
-            d3dformat = D3DFORMAT.D3DFMT_UNKNOWN
-
-        # Ширина и высота
-        width, height = struct.unpack('2h', self.file_stream.read(4))
-        
-        # print(struct.unpack('8s', self.file_stream.read(8)))
-        #depth
-        depth, num_levels, raster_type, \
-        alpha, cube_texture, auto_mip_maps, \
-        compressed, pad_raster_format = struct.unpack('8B', self.file_stream.read(8))
-        # ---------------------------------------------------------------
-
-        return {
-            'platform_id': platform_id, 
-            'filter_mode': filter_mode,
-            'u_addressing': UAddressing,
-            'v_addressing': VAddressing,
-            'pad_texture_format': pad_texture_format[0],
-            'name': name.replace('\x00', ''),
-            'mask_name': mask_name.decode('utf-8', errors='replace').replace('\x00', ''),
-            'raster_format': raster_format,
-            'd3d_format': d3dformat.value,
-            'width': width,
-            'height': height,
-            'depth': depth,
-            'num_levels': num_levels,
-            'raster_type': raster_type,
-            'alpha': alpha,
-            'cube_texture': cube_texture,
-            'auto_mip_maps': auto_mip_maps,
-            'compressed': compressed,
-            'pad_raster_format': pad_raster_format
-        }
-    
-    def get_file_data(self, size):
-        return self.file_stream.read(size)
+        return texture_dictionary, textures
 
+    def read_payload(self, raster_data):
+        # данные растра по записи из read_directory, memoryview без копирования
+        start = raster_data['payload_offset']
+        return self.file_stream.buffer[start:start + raster_data['payload_size']]
 
     def __enter__(self):
-        self.file_stream = open(self.file_path, 'rb')
+        self.file_stream, self._owns_stream = open_stream(self.source)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.file_stream.close()
+        if self._owns_stream:
+            self.file_stream.close()
 
 
+def parse_raster_header(data, default_name='') -> dict:
+    (platform_id, filter_mode, u_addressing, v_addressing, pad_texture_format, name, mask_name,
+     raster_format, d3d_format, width, height, depth, num_levels, raster_type, flags) = RASTER_HEADER.unpack_from(data)
 
-json_data = {}
-
-for i in glob.glob('./txd_files/*.txd'):
     try:
-        json_data[i] = {'info': {}, 'textures': []}
-
-        with TxdReader(i) as f:
-            # Texture Dictionary
-            header_data = f.get_header()
-            if header_data is None:
-                print(f'File {i} is have the broken header')
+        name = name.decode('utf-8')
+    except UnicodeDecodeError:
+        name = default_name
+    try:
+        d3d_format = D3DFORMAT(d3d_format)
+    except ValueError:
+        d3d_format = D3DFORMAT.D3DFMT_UNKNOWN
+
+    return {
+        'platform_id': platform_id,
+        'filter_mode': filter_mode,
+        'u_addressing': u_addressing,
+        'v_addressing': v_addressing,
+        'pad_texture_format': pad_texture_format,
+        'name': name.replace('\x00', ''),
+        'mask_name': mask_name.decode('utf-8', errors='replace').replace('\x00', ''),
+        'raster_format': hex(raster_format),
+        'd3d_format': d3d_format.value,
+        'width': width,
+        'height': height,
+        'depth': depth,
+        'num_levels': num_levels,
+        'raster_type': raster_type,
+        'alpha': int(bool(flags & RASTER_FLAG_ALPHA)),
+        'cube_texture': int(bool(flags & RASTER_FLAG_CUBE_TEXTURE)),
+        'auto_mip_maps': int(bool(flags & RASTER_FLAG_AUTO_MIP_MAPS)),
+        'compressed': int(bool(flags & RASTER_FLAG_COMPRESSED))
+    }
+
+
+def read_raster_levels(raster_data, payload):
+    # Палитра и уровни мипмапов по 4-байтным размерам перед каждым уровнем.
+    # Смещения от начала данных растра (сразу после заголовка)
+    palette = palette_size(int(raster_data['raster_format'], 16))
+    levels = []
+    offset = palette
+    width, height = raster_data['width'], raster_data['height']
+    for i in range(raster_data['num_levels']):
+        if offset + 4 > len(payload):
+            break
+        size = struct.unpack_from('<I', payload, offset)[0]
+        levels.append(MipLevel(offset + 4, size, max(1, width >> i), max(1, height >> i)))
+        offset += 4 + size
+
+    return {
+        'palette_offset': 0,
+        'palette_size': palette,
+        'levels': [asdict(level) for level in levels]
+    }
+
+
+def iter_textures(f: TxdReader):
+    # Yields (raster_data, payload), payload - memoryview всех данных растра после заголовка:
+    # палитра и уровни, их смещения лежат в raster_data['levels']
+    for payload_offset, raster_data, payload in f.iter_rasters():
+        raster_data['payload_offset'] = payload_offset
+        raster_data['payload_size'] = len(payload)
+        raster_data.update(read_raster_levels(raster_data, payload))
+        yield raster_data, payload
+
+
+def iter_txd_sources(img_path=None, manifest=None):
+    # с manifest отдаются только измененные TXD, manifest.update() вызывает тот, кто их обработал
+    if img_path is None:
+        for i in glob.glob('./txd_files/*.txd'):
+            yield i, i
+        return
+
+    from img_archive import ImgArchive
+
+    with ImgArchive(img_path) as archive:
+        entries = archive.get_entries_by_extension('txd')
+        if manifest is not None:
+            entries = manifest.get_changed_entries(archive, entries)
+        for entry in entries:
+            data = archive.get_data(entry)
+            try:
+                yield entry.name, data
+            finally:
+                data.release()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Чтение TXD файлов')
+    parser.add_argument('--img', default=None, help='читать TXD прямо из IMG архива')
+    parser.add_argument('--incremental', action='store_true', help='с --img: разбирать только измененные TXD')
+    parser.add_argument('--index-only', action='store_true', help='только метаданные, без чтения данных текстур')
+    parser.add_argument('--store', default=TEXTURE_STORE_PATH, help='файл метаданных текстур')
+    args = parser.parse_args()
+
+    manifest = None
+    if args.img is not None and args.incremental:
+        from img_archive import ImgArchive
+        from img_manifest import ImgManifest
+
+        manifest = ImgManifest(args.store + '.manifest').load()
+
+    # разобранные TXD, только они отмечаются в манифесте
+    parsed = []
+    # метаданные пишутся по мере разбора, в инкрементальном режиме дописываются к старым
+    with TextureStoreWriter(args.store, append=manifest is not None) as store:
+        if manifest is not None and not store.appended:
+            # старых записей нет, все TXD разбираются заново
+            manifest = ImgManifest(manifest.path)
+        for i, source in iter_txd_sources(args.img, manifest):
+            directory = None
+            try:
+                with TxdReader(source, Path(i).stem) as f:
+                    if args.index_only:
+                        directory = f.read_directory()
+                    else:
+                        texture_dictionary = f.read_texture_dictionary()
+                        if texture_dictionary is not None:
+                            textures = []
+                            for raster_data, payload in iter_textures(f):
+                                textures.append(raster_data)
+
+                                with open(f'./txd_files_data/{raster_data["name"]}.data', 'wb') as d:
+                                    d.write(payload)
+                                if isinstance(payload, memoryview):
+                                    payload.release()
+                            directory = texture_dictionary, textures
+                if directory is None:
+                    print(f'File {i} is have the broken header')
+
+            except Exception as ex:
+                # недоразобранный TXD в хранилище не попадает
+                directory = None
+                print(ex, f'File: {i} {format_exc()}')
+
+            if directory is None:
+                # старые метаданные измененного TXD уже не верны
+                store.remove_txd(Path(i).name)
                 continue
-
-            f.get_section()
-
-            texture_dictionary = f.get_texture_dictionary_data()
-            json_data[i]['info'] = texture_dictionary
-            # Raster
-            f.get_section()
-            
-            section_raster_data = f.get_section()
-
-            for _ in range(texture_dictionary['texture_count']):
-                raster_data = f.get_raster_data()
-                json_data[i]['textures'].append(raster_data)
-                # print(raster_data)
-
-                # print(raster_data['name'], raster_data['d3d_format'], raster_data['raster_format'])
-
-                
-                with open(f'./txd_files_data/{raster_data["name"]}.data', 'wb') as d:
-                    d.write(f.get_file_data(section_raster_data['size'] - 68))
-
-                section_raster_data = f.get_section()
-                print(section_raster_data)
-
-                if section_raster_data is None:
-                    continue
-
-        # print('-----------------')
-    except Exception as ex:
-        print(ex, f'File: {i} {format_exc()}')
-    
-with open('json_data.json', 'w', encoding='utf-8') as f:
-    f.write(json.dumps(json_data))
\ No newline at end of file
+            # и из папки, и из архива TXD хранится под именем файла
+            store.add_txd(Path(i).name, *directory)
+            parsed.append(i)
+
+        if manifest is not None:
+            # TXD, которых больше нет в архиве
+            with ImgArchive(args.img) as archive:
+                for name in store.txd_names():
+                    if name not in archive:
+                        store.remove_txd(name)
+
+    # манифест сохраняется только после того, как хранилище записано
+    if manifest is not None:
+        with ImgArchive(args.img) as archive:
+            manifest.update(archive, parsed)
+        manifest.save()
+
+
+if __name__ == '__main__':
+    main()